@@ -0,0 +1,156 @@
+"""
+Batch conversion helpers shared by the command line tools.
+
+A batch is a list of files, directories or glob patterns. Every file is
+converted in a process pool, and a failing file is reported without
+stopping the rest of the batch.
+"""
+
+import argparse
+import glob
+import logging
+import os
+
+import timing
+
+# Set up once per worker process by _init_worker
+_context = None
+
+
+def expand_inputs(paths: list[str], suffixes: tuple[str, ...]) -> list[str]:
+    """Expand directories and glob patterns into a sorted list of files.
+
+    Directories contribute the files whose names end in one of `suffixes`
+    (case-insensitive). Glob patterns contribute every file they match.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.lower().endswith(suffixes)
+                and os.path.isfile(os.path.join(path, name))
+            )
+        elif glob.has_magic(path):
+            files.extend(p for p in sorted(glob.glob(path)) if os.path.isfile(p))
+        else:
+            files.append(path)
+    return files
+
+
+def output_path(filename: str, out_dir: str, ext: str) -> str:
+    """Where the converted `filename` goes, e.g. out/City.pic.png.
+
+    out_dir is created if it doesn't exist yet.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    return os.path.join(out_dir, f"{os.path.basename(filename)}{ext}")
+
+
+def output_collisions(files: list[str]) -> dict[str, list[str]]:
+    """Inputs that output_path would write to the same file, by base name.
+
+    Naming the same file twice isn't a collision.
+    """
+    by_name = {}
+    for filename in files:
+        paths = by_name.setdefault(os.path.basename(filename), {})
+        paths.setdefault(os.path.realpath(filename), filename)
+    return {
+        name: list(paths.values()) for name, paths in by_name.items() if len(paths) > 1
+    }
+
+
+def _init_worker(setup, setup_args, profile):
+    global _context
+    if profile:
+        timing.enable()
+    _context = setup(*setup_args) if setup else None
+
+
+def _convert_one(convert, filename, out_dir):
+    try:
+        return filename, convert(filename, out_dir, _context), None, timing.take()
+    except Exception as e:
+        return filename, None, f"{type(e).__name__}: {e}", timing.take()
+
+
+def run_batch(convert, files, out_dir, jobs=None, setup=None, setup_args=()) -> int:
+    """Convert `files` in a process pool and return the number of failures.
+
+    setup(*setup_args) runs once in each worker, e.g. to load the palette,
+    and its result is passed to every convert(filename, out_dir, context)
+    call made by that worker. convert returns the path it wrote. Stage
+    timings recorded by the workers are merged into this process.
+
+    Nothing is converted, and every file counts as failed, if two inputs
+    would be written to the same output or setup fails.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    collisions = output_collisions(files)
+    for name, paths in collisions.items():
+        logging.error(f"{', '.join(paths)} would overwrite each other's output")
+    if collisions:
+        return len(files)
+
+    # a setup that fails in the workers only shows up as a broken pool, so
+    # try it here first
+    if setup:
+        try:
+            setup(*setup_args)
+        except Exception as e:
+            logging.error(f"{type(e).__name__}: {e}")
+            return len(files)
+
+    failures = 0
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(setup, setup_args, timing.enabled()),
+    ) as pool:
+        futures = [pool.submit(_convert_one, convert, f, out_dir) for f in files]
+        for future in as_completed(futures):
+            filename, out, error, records = future.result()
+            timing.merge(records)
+            if error is None:
+                logging.info(f"{filename} -> {out}")
+            else:
+                failures += 1
+                logging.error(f"{filename}: {error}")
+
+    if failures:
+        logging.error(f"{failures} of {len(files)} files failed to convert")
+    else:
+        logging.info(f"converted {len(files)} files")
+    return failures
+
+
+def add_batch_arguments(parser):
+    """Add the --output-dir and --jobs options to a command line parser"""
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=".",
+        help="Directory to write converted files to. Defaults to the current directory.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=job_count,
+        default=None,
+        help="Number of worker processes, for the files of a batch or the planes "
+        "and LZW segments of a single PIC file. Defaults to the CPU count.",
+    )
+
+
+def job_count(value: str) -> int:
+    """Parse a --jobs option, at least 1"""
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"expected at least 1 job, got {value!r}")
+    return jobs
@@ -1,3 +1,5 @@
+from functools import partial
+import os
 import struct
 
 """
@@ -9,72 +11,85 @@ format
 """
 
 
-class BitStream:
-    def __init__(self, file):
-        self.fp = file
-        self.count = 0x10
-        buf = self.fp.read(2)
-        if len(buf) < 2:
-            raise EOFError("Unexpected EOF while initializing bit buffer")
-        self.buf = struct.unpack("<H", buf)[0]
-
-    def getbit(self):
-        b = self.buf & 1
-        self.count -= 1
-        if self.count == 0:
-            buf = self.fp.read(2)
-            if len(buf) < 2:
-                raise EOFError("Unexpected EOF while reloading bit buffer")
-            self.buf = struct.unpack("<H", buf)[0]
-            self.count = 0x10
-        else:
-            self.buf >>= 1
-        return b
-
-
 def lzss_decompress(ifile, start_offset=0):
     # Seek to compressed data start
     ifile.seek(start_offset)
-    bits = BitStream(ifile)
-    data = bytearray(0x4500)
+    return lzss_decompress_bytes(ifile.read())
+
+
+def lzss_decompress_bytes(src, out_size=None) -> bytearray:
+    """
+    Decompress an LZSS stream held in memory (bytes, bytearray or memoryview).
+
+    out_size is the expected output size, e.g. width * height / 8 for a Pic98
+    plane. The output is written into a buffer of that size up front and only
+    grows if the stream turns out to be longer.
+    """
+    src = memoryview(src).cast("B")
+    src_len = len(src)
+    if src_len < 2:
+        raise EOFError("Unexpected EOF while initializing bit buffer")
+
+    out = bytearray(out_size if out_size is not None else 4 * src_len)
+    # A single token writes at most 256 bytes, grow before we could overflow
+    limit = len(out) - 0x100
     p = 0
-    out = bytearray()
+
+    # Bits come LSB first from 16-bit little-endian words. The next word is
+    # read as soon as the last bit of the current one is used, which places
+    # it before any data bytes that follow that bit.
+    bitbuf = src[0] | (src[1] << 8)
+    bitcount = 0x10
+    pos = 2
+
+    def getbit():
+        nonlocal bitbuf, bitcount, pos
+        if bitcount == 0:
+            raise EOFError("Unexpected EOF while reloading bit buffer")
+        b = bitbuf & 1
+        bitcount -= 1
+        if bitcount == 0:
+            if pos + 2 <= src_len:
+                bitbuf = src[pos] | (src[pos + 1] << 8)
+                pos += 2
+                bitcount = 0x10
+        else:
+            bitbuf >>= 1
+        return b
 
     while True:
-        if p > 0x4000:
-            out.extend(data[:0x2000])
-            data[:0x2500] = data[0x2000:p] + bytearray(0x500)  # Slide
-            p -= 0x2000
-
-        if bits.getbit():
-            b = ifile.read(1)
-            if not b:
+        if p > limit:
+            out.extend(bytearray(max(len(out), 0x100)))
+            limit = len(out) - 0x100
+
+        if getbit():
+            if pos >= src_len:
                 break
-            data[p] = b[0]
+            out[p] = src[pos]
+            pos += 1
             p += 1
             continue
 
-        if not bits.getbit():
-            len_ = (bits.getbit() << 1) | bits.getbit()
+        if not getbit():
+            len_ = (getbit() << 1) | getbit()
             len_ += 2
-            b = ifile.read(1)
-            if not b:
+            if pos >= src_len:
                 break
-            span = b[0] | 0xFF00
+            dist = 0x100 - src[pos]
+            pos += 1
         else:
-            b1 = ifile.read(1)
-            b2 = ifile.read(1)
-            if not b1 or not b2:
+            if pos + 2 > src_len:
                 break
-            span = b1[0]
-            len_ = b2[0]
-            span |= ((len_ & ~0x07) << 5) | 0xE000
-            len_ = (len_ & 0x07) + 2
+            b1 = src[pos]
+            b2 = src[pos + 1]
+            pos += 2
+            dist = 0x2000 - (b1 | ((b2 & 0xF8) << 5))
+            len_ = (b2 & 0x07) + 2
             if len_ == 2:
-                b = ifile.read(1)
-                if not b:
+                if pos >= src_len:
                     break
-                len_ = b[0]
+                len_ = src[pos]
+                pos += 1
                 if len_ == 0:
                     break  # End of stream
                 elif len_ == 1:
@@ -82,17 +97,57 @@ def lzss_decompress(ifile, start_offset=0):
                 else:
                     len_ += 1
 
-        for _ in range(len_):
-            ref = p + int(struct.unpack("<h", struct.pack("<H", span))[0])
-            data[p] = data[ref]
-            p += 1
+        ref = p - dist
+        if ref < 0:
+            raise ValueError(f"Back-reference before start of data at {p}")
+        if dist >= len_:
+            out[p : p + len_] = out[ref : ref + len_]
+        else:
+            # Overlapping copy repeats the last `dist` bytes
+            out[p : p + len_] = (out[ref:p] * (len_ // dist + 1))[:len_]
+        p += len_
 
-    out.extend(data[:p])
+    del out[p:]
     return out
 
 
+# Below these sizes starting a process pool costs more than it saves, so
+# the blocks are done one after another (plane data and compressed data)
+PARALLEL_COMPRESS_MIN = 16 * 1024
+PARALLEL_DECOMPRESS_MIN = 128 * 1024
+
+
+def _map_blocks(func, blocks, jobs, size, min_size) -> list:
+    """func over blocks in up to `jobs` processes, results in block order"""
+    workers = min(jobs or os.cpu_count() or 1, len(blocks))
+    if workers < 2 or size < min_size:
+        return [func(block) for block in blocks]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, blocks))
+
+
+def lzss_decompress_all(blocks, out_size=None, jobs=None) -> list[bytearray]:
+    """
+    Decompress independent streams, e.g. the 4 Pic98 planes, in parallel.
+
+    jobs is the number of worker processes, None for one per CPU and 1 to
+    decompress them in this process. Small inputs are always decompressed
+    here.
+    """
+    return _map_blocks(
+        partial(lzss_decompress_bytes, out_size=out_size),
+        blocks,
+        jobs,
+        sum(map(len, blocks)),
+        PARALLEL_DECOMPRESS_MIN,
+    )
+
+
 class BitWriter:
-    """Bit writer that matches the BitStream reader format"""
+    """Bit writer that matches the lzss_decompress bit reader format"""
 
     def __init__(self):
         self.data = bytearray()
@@ -125,14 +180,288 @@ https://canadianavenger.io/2024/07/04/sometimes-you-need-a-hammer/
 """
 
 
-def lzss_compress(data):
+class MatchFinder:
+    """
+    Hash-chain match finder for the LZSS window.
+
+    Every position is chained to the previous position that starts with the
+    same 3 bytes, so walking a chain visits candidates nearest first and the
+    first of several equally long matches is also the closest one. Matches of
+    exactly 2 bytes only need the most recent position with the same 2-byte
+    prefix. Positions must be inserted in order, and find(pos) sees every
+    position inserted before it.
+    """
+
+    def __init__(self, data, window=8192, max_len=253, max_chain=None):
+        self.data = data
+        self.window = window
+        self.max_len = max_len
+        # None walks the whole chain, which finds the same match as a full
+        # window search
+        self.max_chain = max_chain
+        self.head2 = [-1] * 0x10000
+        self.head3 = {}
+        self.prev3 = [-1] * len(data)
+
+    def insert(self, pos):
+        data = self.data
+        if pos + 2 < len(data):
+            key = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+            self.prev3[pos] = self.head3.get(key, -1)
+            self.head3[key] = pos
+        if pos + 1 < len(data):
+            self.head2[(data[pos] << 8) | data[pos + 1]] = pos
+
+    def find(self, pos):
+        """Return (length, distance) of the longest match, closest on ties"""
+        data = self.data
+        max_len = min(self.max_len, len(data) - pos)
+        if max_len < 2:
+            return 0, 0
+        window_start = pos - self.window
+
+        best_length = 0
+        best_distance = 0
+        if max_len >= 3:
+            key = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+            cand = self.head3.get(key, -1)
+            chain = self.max_chain
+            while cand >= window_start and cand >= 0:
+                # A candidate can only be longer if it also matches the byte
+                # just past the current best
+                if data[cand + best_length] == data[pos + best_length]:
+                    length = _common_prefix(data, cand, pos, max_len)
+                    if length > best_length:
+                        best_length = length
+                        best_distance = pos - cand
+                        if length == max_len:
+                            break
+                if chain is not None:
+                    chain -= 1
+                    if chain <= 0:
+                        break
+                cand = self.prev3[cand]
+            if best_length:
+                return best_length, best_distance
+
+        cand = self.head2[(data[pos] << 8) | data[pos + 1]]
+        if cand >= window_start and cand >= 0:
+            return 2, pos - cand
+        return 0, 0
+
+    def find_all(self, pos):
+        """Return the (length, distance) of every match that's longer than all
+        closer ones, shortest and closest first. Each one is the closest match
+        for every length up to its own."""
+        data = self.data
+        max_len = min(self.max_len, len(data) - pos)
+        if max_len < 2:
+            return []
+        window_start = pos - self.window
+
+        matches = []
+        cand = self.head2[(data[pos] << 8) | data[pos + 1]]
+        if cand >= window_start and cand >= 0:
+            matches.append((2, pos - cand))
+        if max_len >= 3:
+            best_length = 2
+            key = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+            cand = self.head3.get(key, -1)
+            chain = self.max_chain
+            while cand >= window_start and cand >= 0:
+                if data[cand + best_length] == data[pos + best_length]:
+                    length = _common_prefix(data, cand, pos, max_len)
+                    if length > best_length:
+                        best_length = length
+                        matches.append((length, pos - cand))
+                        if length == max_len:
+                            break
+                if chain is not None:
+                    chain -= 1
+                    if chain <= 0:
+                        break
+                cand = self.prev3[cand]
+        return matches
+
+
+def _common_prefix(data, a, b, max_len):
+    """Length of the common prefix of data[a:] and data[b:], up to max_len"""
+    if data[a : a + max_len] == data[b : b + max_len]:
+        return max_len
+    # data[a:a+lo] matches, data[a:a+hi] doesn't
+    lo, hi = 0, max_len
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if data[a : a + mid] == data[b : b + mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+# Greedy, lazy and optimal parsing, see lzss_compress
+LEVELS = (0, 1, 2)
+
+# Optimal parsing takes matches at least this long as they are, like lzma's
+# "nice length", instead of trying every shorter length at every position
+NICE_LENGTH = 64
+
+LITERAL_BITS = 9
+
+# How many earlier positions each level tries for a match by default, None
+# for all of them. Lazy and optimal parsing look for matches at far more
+# positions than greedy, and on sprites a full chain search makes optimal
+# parsing about 15 times slower for 2% smaller output. Fewer than 256 makes
+# lazy parsing lose to greedy.
+MAX_CHAIN = {0: None, 1: 256, 2: 256}
+
+
+def token_bits(length, distance):
+    """Bits needed for a match, or None if it can't be encoded
+
+    Short form is 2 flag bits + 2 length bits + 1 byte for lengths 2-5 up to
+    256 back, long form is 2 flag bits + 2 bytes for lengths 3-9 and + 3 bytes
+    for anything longer.
+    """
+    if length < 2:
+        return None
+    if length <= 5 and distance <= 256:
+        return 4 + 8
+    if length < 3:
+        return None
+    if length <= 9:
+        return 2 + 16
+    return 2 + 24
+
+
+def _greedy_tokens(data, finder):
+    """Take the longest match at every position"""
+    pos = 0
+    while pos < len(data):
+        length, distance = finder.find(pos)
+        if length < 2 or (length == 2 and distance >= 256):
+            length, distance = 1, 0
+        for p in range(pos, pos + length):
+            finder.insert(p)
+        yield length, distance
+        pos += length
+
+
+def _lazy_tokens(data, finder):
+    """Like greedy, but emit a literal instead of a match when a literal and
+    the match at the next position cost fewer bits per byte"""
+    pos = 0
+    match = finder.find(0)
+    while pos < len(data):
+        length, distance = match
+        finder.insert(pos)
+        if token_bits(length, distance) is None:
+            yield 1, 0
+            pos += 1
+            match = finder.find(pos)
+            continue
+        if length < NICE_LENGTH and pos + 1 < len(data):
+            match = finder.find(pos + 1)
+            bits = token_bits(*match)
+            # Compare bits per byte, the literal is part of the next token
+            if bits is not None and (LITERAL_BITS + bits) * length < token_bits(
+                length, distance
+            ) * (match[0] + 1):
+                yield 1, 0
+                pos += 1
+                continue
+        for p in range(pos + 1, pos + length):
+            finder.insert(p)
+        yield length, distance
+        pos += length
+        match = finder.find(pos)
+
+
+def _optimal_tokens(data, finder):
+    """Find the cheapest sequence of tokens in bits for the whole input"""
+    n = len(data)
+    cost = [0] + [float("inf")] * n
+    # The token that reaches each position on its cheapest path
+    token_length = [0] * (n + 1)
+    token_distance = [0] * (n + 1)
+
+    pos = 0
+    while pos < n:
+        matches = finder.find_all(pos)
+        finder.insert(pos)
+        base = cost[pos]
+
+        if base + LITERAL_BITS < cost[pos + 1]:
+            cost[pos + 1] = base + LITERAL_BITS
+            token_length[pos + 1] = 1
+            token_distance[pos + 1] = 0
+
+        if matches and matches[-1][0] >= NICE_LENGTH:
+            length, distance = matches[-1]
+            bits = base + token_bits(length, distance)
+            if bits < cost[pos + length]:
+                cost[pos + length] = bits
+                token_length[pos + length] = length
+                token_distance[pos + length] = distance
+            for p in range(pos + 1, pos + length):
+                finder.insert(p)
+            pos += length
+            continue
+
+        shorter = 1
+        for longest, distance in matches:
+            for length in range(shorter + 1, longest + 1):
+                bits = token_bits(length, distance)
+                if bits is not None and base + bits < cost[pos + length]:
+                    cost[pos + length] = base + bits
+                    token_length[pos + length] = length
+                    token_distance[pos + length] = distance
+            shorter = longest
+        pos += 1
+
+    tokens = []
+    pos = n
+    while pos > 0:
+        tokens.append((token_length[pos], token_distance[pos]))
+        pos -= token_length[pos]
+    return reversed(tokens)
+
+
+_PARSERS = {0: _greedy_tokens, 1: _lazy_tokens, 2: _optimal_tokens}
+
+
+def chain_depth(level, max_chain=None):
+    """The number of positions lzss_compress tries per match for these
+    arguments, None for all of them"""
+    if max_chain is None:
+        return MAX_CHAIN[level]
+    return max_chain or None
+
+
+def lzss_compress(data, max_chain=None, level=0):
     """
     LZSS compressor implementing Sega's Kosinski compression algorithm.
-    Uses a greedy approach to match the original behavior.
+
+    level chooses how matches are picked:
+    0 - greedy, takes the longest match at every position (the original
+        behavior, fastest)
+    1 - lazy, emits a literal instead when the next position has a longer
+        match
+    2 - optimal, finds the cheapest sequence of tokens for the whole input
+        from their bit costs (see token_bits, slowest)
+
+    max_chain limits how many earlier positions are tried for each match,
+    and 0 tries all of them. The default depends on the level, see
+    MAX_CHAIN. Greedy tries all of them, which gives the same output as
+    searching every distance in the window.
     """
+    if level not in _PARSERS:
+        raise ValueError(f"Unknown LZSS level: {level}")
     if not data:
         return b""
 
+    data = bytes(data)
+
     # Use Kosinski-style descriptor bit packing
     output = bytearray()
     descriptor = 0
@@ -162,75 +491,50 @@ def lzss_compress(data):
     def put_match_byte(byte):
         match_buffer.append(byte)
 
+    finder = MatchFinder(data, max_chain=chain_depth(level, max_chain))
     pos = 0
-    while pos < len(data):
-        # Simple single-pass search: find longest match, preferring closer distances
-        best_length = 0
-        best_distance = 0
-        max_len = min(253, len(data) - pos)
-        search_end = min(pos, 8192)  # 8K sliding window
-
-        for distance in range(1, search_end + 1):
-            length = 0
-
-            # Count matching bytes
-            while (
-                length < max_len
-                and pos + length < len(data)
-                and data[pos + length] == data[pos - distance + length]
-            ):
-                length += 1
-
-            # Update if we found a longer match (closer distance wins ties)
-            if length > best_length:
-                best_length = length
-                best_distance = distance
-
-        # Decide literal vs match
-        if best_length < 2 or (best_length == 2 and best_distance >= 256):
+    for best_length, best_distance in _PARSERS[level](data, finder):
+        if best_distance == 0:
             # Output literal
             put_bit(True)
             put_match_byte(data[pos])
             pos += 1
-        else:
-            # Output match
+            continue
+
+        # Output match
+        put_bit(False)
+
+        if best_length <= 5 and best_distance <= 256:
+            # Short form: 4 bits total - 00 + 2 length bits
             put_bit(False)
 
-            if best_length <= 5 and best_distance <= 256:
-                # Short form: 4 bits total - 00 + 2 length bits
-                put_bit(False)
+            # Length in 2 bits (0-3 for lengths 2-5)
+            length_code = best_length - 2
+            put_bit(bool(length_code & 2))
+            put_bit(bool(length_code & 1))
 
-                # Length in 2 bits (0-3 for lengths 2-5)
-                length_code = best_length - 2
-                put_bit(bool(length_code & 2))
-                put_bit(bool(length_code & 1))
+            # Distance byte (negated)
+            put_match_byte((-best_distance) & 0xFF)
+        else:
+            # Long form: 2 bits - 01
+            put_bit(True)
+
+            neg_distance = (-best_distance) & 0x1FFF
+            put_match_byte(neg_distance & 0xFF)
 
-                # Distance byte (negated)
-                put_match_byte((-best_distance) & 0xFF)
+            if best_length <= 9:
+                # Standard long pointer
+                length_code = best_length - 2
+                # From documentation: distance >>= 5, then & 0x00f8, then OR with length
+                high_byte = ((neg_distance >> 5) & 0x00F8) | (length_code & 0x07)
+                put_match_byte(high_byte)
             else:
-                # Long form: 2 bits - 01
-                put_bit(True)
-
-                # Limit to 253 like MicroProse implementation
-                if best_length > 253:
-                    best_length = 253
-
-                neg_distance = (-best_distance) & 0x1FFF
-                put_match_byte(neg_distance & 0xFF)
-
-                if best_length <= 9:
-                    # Standard long pointer
-                    length_code = best_length - 2
-                    # From documentation: distance >>= 5, then & 0x00f8, then OR with length
-                    high_byte = ((neg_distance >> 5) & 0x00F8) | (length_code & 0x07)
-                    put_match_byte(high_byte)
-                else:
-                    # Long-long pointer
-                    high_byte = (neg_distance >> 5) & 0x00F8
-                    put_match_byte(high_byte)
-                    put_match_byte(best_length - 1)
+                # Long-long pointer
+                high_byte = (neg_distance >> 5) & 0x00F8
+                put_match_byte(high_byte)
+                put_match_byte(best_length - 1)
 
-            pos += best_length
+        pos += best_length
 
     # Termination
     put_bit(False)
@@ -239,8 +543,10 @@ def lzss_compress(data):
     put_match_byte(0xF0)
     put_match_byte(0x00)
 
-    # Flush remaining bits
-    if descriptor_bits > 0:
+    # Flush remaining bits. If the terminator filled the descriptor its
+    # bytes are still buffered, and the reader expects a new descriptor
+    # word before them.
+    if descriptor_bits > 0 or match_buffer:
         flush_descriptor()
 
     # Pad to 16-byte boundary like the original compressor
@@ -248,3 +554,19 @@ def lzss_compress(data):
         output.append(0x00)
 
     return bytes(output)
+
+
+def lzss_compress_all(blocks, max_chain=None, level=0, jobs=None) -> list[bytes]:
+    """
+    Compress independent blocks, e.g. the 4 Pic98 planes, in parallel.
+
+    Same output as calling lzss_compress on each block, in block order. jobs
+    works like in lzss_decompress_all.
+    """
+    return _map_blocks(
+        partial(lzss_compress, max_chain=max_chain, level=level),
+        blocks,
+        jobs,
+        sum(map(len, blocks)),
+        PARALLEL_COMPRESS_MIN,
+    )
@@ -0,0 +1,11 @@
+"""
+Codec benchmarks.
+
+Run from the repository root:
+
+    python -m bench -o bench.json
+
+A synthetic corpus is generated from a fixed seed, every codec stage is
+timed on it separately, and the results are written as JSON so runs from
+before and after a codec change can be compared.
+"""
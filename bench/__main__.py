@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+from contextlib import redirect_stdout
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from bench.corpus import KINDS, make_corpus
+from bench.stages import STAGES
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m bench", description="Benchmark the PIC and SPR codecs"
+    )
+    parser.add_argument(
+        "-o", "--output", help="Write JSON results to this file instead of stdout."
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Time each stage this many times and keep the fastest. Defaults to 3.",
+    )
+    parser.add_argument(
+        "-s",
+        "--stage",
+        action="append",
+        choices=[s.name for s in STAGES],
+        help="Only run this stage. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "-k",
+        "--kind",
+        action="append",
+        choices=KINDS,
+        help="Only use images of this kind. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1994, help="Seed for the synthetic corpus."
+    )
+    args = parser.parse_args()
+
+    stages = [s for s in STAGES if not args.stage or s.name in args.stage]
+    samples = make_corpus(args.seed, args.kind or KINDS)
+
+    results = []
+    for sample in samples:
+        for stage in stages:
+            if stage.kinds and sample.kind not in stage.kinds:
+                continue
+            result = run_stage(stage, sample, args.repeat)
+            print(
+                f"{sample.name:>18} {stage.name:<16} "
+                f"{result['mb_per_s']:>9.2f} MB/s {result['peak_kib']:>9} KiB",
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def run_stage(stage, sample, repeat: int) -> dict:
+    """Time one stage on one sample and measure its peak memory"""
+    # Some codecs print progress, keep it out of the report
+    with redirect_stdout(io.StringIO()):
+        run_args, raw_bytes = stage.prepare(sample)
+
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stage.run(*run_args)
+            best = min(best, time.perf_counter() - start)
+
+        # tracemalloc slows allocation down, so memory gets its own run
+        tracemalloc.start()
+        try:
+            stage.run(*run_args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "sample": sample.name,
+        "kind": sample.kind,
+        "width": sample.width,
+        "height": sample.height,
+        "stage": stage.name,
+        "raw_bytes": raw_bytes,
+        "seconds": best,
+        "mb_per_s": raw_bytes / best / 1e6 if best > 0 else 0.0,
+        "peak_kib": peak // 1024,
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Deterministic synthetic images at the resolutions the games use"""
+
+from collections import namedtuple
+
+import numpy as np
+
+# Civilization / Darklands VGA, PC-98, Shandalar
+RESOLUTIONS = [(320, 200), (640, 400), (640, 480)]
+
+KINDS = ["flat", "noise", "dithered", "sprite"]
+
+Sample = namedtuple("Sample", ["name", "kind", "width", "height", "pixels"])
+
+# 4x4 Bayer matrix for ordered dithering
+_BAYER4 = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]])
+
+
+def flat(rng, width, height):
+    """A few large single colour rectangles, like title and menu screens"""
+    img = np.full((height, width), rng.integers(1, 256), dtype=np.uint8)
+    for _ in range(12):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        w, h = rng.integers(8, width // 2), rng.integers(8, height // 2)
+        img[y : y + h, x : x + w] = rng.integers(0, 256)
+    return img
+
+
+def noise(rng, width, height):
+    """Uniform random indexes, the worst case for every codec"""
+    return rng.integers(0, 256, size=(height, width), dtype=np.uint8)
+
+
+def dithered(rng, width, height):
+    """A smooth 'photo' ordered-dithered down to a 32 colour ramp"""
+    y, x = np.mgrid[0:height, 0:width]
+    fx, fy = rng.uniform(0.005, 0.03, size=2)
+    photo = (np.sin(x * fx) + np.cos(y * fy) + np.sin((x + y) * fx / 2)) / 3
+    photo = (photo + 1) / 2 * 31
+    threshold = _BAYER4[y % 4, x % 4] / 16
+    return (np.floor(photo + threshold).clip(0, 31) + 16).astype(np.uint8)
+
+
+def sprite(rng, width, height):
+    """Mostly transparent (0) with scattered opaque blobs"""
+    img = np.zeros((height, width), dtype=np.uint8)
+    y, x = np.mgrid[0:height, 0:width]
+    for _ in range(width * height // 4000):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        r = rng.integers(4, 24)
+        blob = (x - cx) ** 2 + (y - cy) ** 2 < r * r
+        img[blob] = rng.integers(1, 256, size=int(blob.sum()), dtype=np.uint8)
+    return img
+
+
+_GENERATORS = {"flat": flat, "noise": noise, "dithered": dithered, "sprite": sprite}
+
+
+def make_corpus(seed=1994, kinds=KINDS, resolutions=RESOLUTIONS) -> list[Sample]:
+    """Build the corpus, the same seed always gives the same pixels"""
+    samples = []
+    for kind in kinds:
+        for width, height in resolutions:
+            rng = np.random.default_rng([seed, KINDS.index(kind), width, height])
+            pixels = _GENERATORS[kind](rng, width, height).tobytes()
+            name = f"{kind}-{width}x{height}"
+            samples.append(Sample(name, kind, width, height, pixels))
+    return samples
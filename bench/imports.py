@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Check how long the command line tools take to import.
+
+Run from the repository root:
+
+    python -m bench.imports --budget-ms 150
+
+Each module is imported in a fresh interpreter with -X importtime. The check
+fails if a module takes longer than the budget, or if importing it loads
+PIL or NumPy, which the tools only import in the code that needs them.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+MODULES = (
+    "mptools",
+    "pic2png",
+    "png2pic",
+    "spr2png",
+    "png2spr",
+    "jpg2png",
+    "mpclient",
+    "sniff",
+    "lzw",
+    "rle",
+)
+
+# Must not be loaded by importing any of MODULES
+HEAVY = ("PIL", "numpy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.imports",
+        description="Check the cold-start import time of the tools",
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=150,
+        help="Fail if a module takes longer than this to import. Defaults to "
+        "%(default)s.",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="Import each module this many times and keep the fastest. "
+        "Defaults to %(default)s.",
+    )
+    args = parser.parse_args()
+
+    failures = 0
+    for module in MODULES:
+        ms, heavy = min(import_time(module) for _ in range(args.repeat))
+        problems = []
+        if heavy:
+            problems.append(f"loads {', '.join(heavy)}")
+        if ms > args.budget_ms:
+            problems.append(f"over the {args.budget_ms:g} ms budget")
+        print(f"{module:<10} {ms:>8.1f} ms  {'; '.join(problems) or 'ok'}")
+        failures += bool(problems)
+
+    sys.exit(1 if failures else 0)
+
+
+def import_time(module: str) -> tuple[float, list[str]]:
+    """Milliseconds to import module in a new interpreter, and the HEAVY
+    modules it loaded"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module}; print(*(m for m in {HEAVY!r} if m in sys.modules))",
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # "import time: self [us] | cumulative | imported package", the module
+    # itself is the line without indentation
+    micros = 0
+    for line in result.stderr.splitlines():
+        _, _, fields = line.partition("import time:")
+        parts = fields.split("|")
+        if len(parts) == 3 and parts[2].rstrip() == f" {module}":
+            micros = int(parts[1])
+    return micros / 1000, result.stdout.split()
+
+
+if __name__ == "__main__":
+    main()
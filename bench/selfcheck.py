@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Check that the codecs round-trip, that their fast paths agree and that the
+encoders still write the same bytes.
+
+Run from the repository root:
+
+    python -m bench.selfcheck
+
+On every 320x200 image of the benchmark corpus this checks that
+
+- rle.encode, lzw.compress and greedy lzss_compress give the same output as
+  when GOLDEN was recorded, so files written by png2pic don't change
+- rle.decode(rle.encode(x)) is x
+- lzw.decompress_rle, the fused LZW+RLE decoder, gives the same pixels as
+  lzw.decompress followed by rle.decode, and decompress_rle_parallel gives
+  the same as both, also on a stream cut off halfway
+- lzss_compress round-trips through lzss_decompress_bytes at every level,
+  and lzss_compress_all gives the same blocks in a process pool as in this
+  process
+- quantize with Floyd-Steinberg dithering gives the same image as PIL's
+  quantize, which png2pic used before the lookup tables
+
+and that the nearest-colour lookup table of QUANTIZE_PALETTE hasn't changed.
+It fails if any of them doesn't.
+
+The digests only hold for the default seed. If an encoder's output changes
+on purpose, record the new ones with --print-golden.
+"""
+
+import argparse
+import hashlib
+import sys
+
+from bellard_lzss4 import (
+    LEVELS,
+    lzss_compress,
+    lzss_compress_all,
+    lzss_decompress_bytes,
+)
+from bench.corpus import KINDS, make_corpus
+import lzw
+import rle
+
+DEFAULT_SEED = 1994
+
+# Worker counts decompress_rle_parallel is checked with, the image is cut
+# into that many runs of LZW segments
+PARALLEL_JOBS = (2, 3)
+
+# SHA-256 of rle.encode(pixels), lzw.compress of that and the greedy
+# lzss_compress of the four quarters of the pixels, for each image of the
+# default seed. All three match the encoders the repository started with.
+GOLDEN = {
+    "flat-320x200": {
+        "rle": "55ce0bd4db5876e74e916ab1b188622e66b18af5ff0241efb882213e8e856247",
+        "lzw": "09bc5c251d2692b976b2c20ca3b3f39f5cf2fef04f74016dd55f219c16a9b7a1",
+        "lzss": "72e39ec38be9f9b5d7f41dcc1123ae35adb74742c09b00c066e583645e466f7f",
+    },
+    "noise-320x200": {
+        "rle": "33d1d3e2c1f65d3b2e056959eada6593a08f9770aed09504b53af041f32ec36e",
+        "lzw": "5f429c1ecb1db204c1d4aca94a73582ae7fb453d6325d8dba53c61ed626344a7",
+        "lzss": "0f0da9f7ca7683ad1bd8ee93f98a74071c5dd279b35395c74a2f4d4df5358153",
+    },
+    "dithered-320x200": {
+        "rle": "1a72a4b647946fad896a241422840f2499ddc4dffa9071126c02186793b25f3e",
+        "lzw": "2c0e4e3557debf6140063ece233f7e2ee4f89fc6b71a08b726b9270c7a7463aa",
+        "lzss": "cecc80801e62c9fc4e6efc72782c19199f54570b9de0b7a1e821e11e501f7719",
+    },
+    "sprite-320x200": {
+        "rle": "790aac130012eebe1b4ce093602c2b9d76d870cbc384b3b0b9bd0613ef169f8e",
+        "lzw": "1a2e6abc436807a75f781363962ab215f8380fa9b8741f2cd1eb3017a6d9804d",
+        "lzss": "8d619b808075adb84164e03c72c4c70e40abc20dc454880cea85770eafdc1904",
+    },
+}
+
+# A 6x6x6 colour cube and 40 greys
+QUANTIZE_PALETTE = bytes(
+    c * 51 for r in range(6) for g in range(6) for b in range(6) for c in (r, g, b)
+) + bytes(round(i * 255 / 39) for i in range(40) for _ in range(3))
+
+# SHA-256 of quantize.build_lut(QUANTIZE_PALETTE)
+GOLDEN_LUT = "0d6653f615d6d7eb2545fcb9cf344f276119117633f4189febe28ea7f9e33f47"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.selfcheck",
+        description="Check that the codecs round-trip and agree with each other",
+    )
+    parser.add_argument(
+        "-k",
+        "--kind",
+        action="append",
+        choices=KINDS,
+        help="Only use images of this kind. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=DEFAULT_SEED,
+        help="Seed for the synthetic corpus. The encoder output is only "
+        "checked for the default seed.",
+    )
+    parser.add_argument(
+        "--print-golden",
+        action="store_true",
+        help="Print the digests of the encoder output instead of checking.",
+    )
+    args = parser.parse_args()
+
+    samples = make_corpus(args.seed, args.kind or KINDS, [(320, 200)])
+    if args.print_golden:
+        for sample in samples:
+            print(f"    {sample.name!r}: {encoder_digests(sample.pixels)!r},")
+        print(f"GOLDEN_LUT = {lut_digest()!r}")
+        return
+
+    failures = 0
+    for sample in samples:
+        golden = GOLDEN[sample.name] if args.seed == DEFAULT_SEED else {}
+        for name, check in CHECKS:
+            problems = check(sample, golden)
+            print(f"{sample.name:>18} {name:<8} {'; '.join(problems) or 'ok'}")
+            failures += bool(problems)
+
+    problems = [] if lut_digest() == GOLDEN_LUT else ["build_lut output changed"]
+    print(f"{'palette':>18} {'lut':<8} {'; '.join(problems) or 'ok'}")
+    failures += bool(problems)
+
+    sys.exit(1 if failures else 0)
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _quarters(pixels: bytes) -> list[bytes]:
+    """Four blocks, like the planes of a Pic98 image"""
+    quarter = len(pixels) // 4
+    return [pixels[i * quarter : (i + 1) * quarter] for i in range(4)]
+
+
+def encoder_digests(pixels: bytes) -> dict:
+    encoded = bytes(rle.encode(pixels))
+    return {
+        "rle": _sha256(encoded),
+        "lzw": _sha256(bytes(lzw.compress(encoded))),
+        "lzss": _sha256(b"".join(lzss_compress(b) for b in _quarters(pixels))),
+    }
+
+
+def lut_digest() -> str:
+    from quantize import build_lut
+
+    return _sha256(build_lut(QUANTIZE_PALETTE).tobytes())
+
+
+def check_rle(sample, golden: dict) -> list[str]:
+    pixels = sample.pixels
+    problems = []
+    encoded = bytes(rle.encode(pixels))
+    if golden and _sha256(encoded) != golden["rle"]:
+        problems.append("rle.encode output changed")
+    if rle.decode(encoded) != pixels:
+        problems.append("decode(encode(x)) differs from x")
+    return problems
+
+
+def check_lzw(sample, golden: dict) -> list[str]:
+    pixels = sample.pixels
+    problems = []
+    stream = bytes(lzw.compress(rle.encode(pixels)))
+    if golden and _sha256(stream) != golden["lzw"]:
+        problems.append("lzw.compress output changed")
+
+    for label, data in (("", stream), ("cut off ", stream[: len(stream) // 2])):
+        expected = unfused_decode(data, len(pixels))
+        if data is stream and expected != pixels:
+            problems.append("decompress+rle.decode differs from the input")
+
+        if lzw.decompress_rle(data, len(pixels)) != expected:
+            problems.append(f"{label}decompress_rle differs from the unfused decode")
+        for jobs in PARALLEL_JOBS:
+            parallel = lzw.decompress_rle_parallel(data, len(pixels), jobs=jobs)
+            if parallel != expected:
+                problems.append(
+                    f"{label}decompress_rle_parallel with {jobs} jobs differs "
+                    "from the unfused decode"
+                )
+    return problems
+
+
+def unfused_decode(data: bytes, size: int) -> bytearray:
+    """LZW-decode, then expand RLE, padded or cut to size like decompress_rle"""
+    plain = rle.decode(bytes(lzw.decompress(data)))[:size]
+    return plain + b"\xff" * (size - len(plain))
+
+
+def check_lzss(sample, golden: dict) -> list[str]:
+    problems = []
+    blocks = _quarters(sample.pixels)
+    for level in LEVELS:
+        compressed = [lzss_compress(block, level=level) for block in blocks]
+        if level == 0 and golden and _sha256(b"".join(compressed)) != golden["lzss"]:
+            problems.append("greedy lzss_compress output changed")
+        for block, data in zip(blocks, compressed):
+            if lzss_decompress_bytes(data, len(block)) != block:
+                problems.append(f"level {level} doesn't round-trip")
+                break
+        if lzss_compress_all(blocks, level=level, jobs=2) != compressed:
+            problems.append(f"level {level} differs in a process pool")
+    return problems
+
+
+def check_quantize(sample, golden: dict) -> list[str]:
+    from PIL import Image
+
+    from quantize import quantize
+
+    # the indexes as RGB colours that mostly aren't in the palette, so there
+    # is error to diffuse
+    image = Image.frombytes("P", (sample.width, sample.height), sample.pixels)
+    image.putpalette(bytes(c for i in range(256) for c in (i, (i * 7) & 0xFF, 255 - i)))
+    image = image.convert("RGB")
+
+    palette_image = Image.new("P", (16, 16))
+    palette_image.putpalette(QUANTIZE_PALETTE)
+    expected = image.quantize(palette=palette_image, dither=Image.FLOYDSTEINBERG)
+    if quantize(image, QUANTIZE_PALETTE).tobytes() != expected.tobytes():
+        return ["floyd-steinberg differs from PIL's quantize"]
+    return []
+
+
+CHECKS = [
+    ("rle", check_rle),
+    ("lzw", check_lzw),
+    ("lzss", check_lzss),
+    ("quantize", check_quantize),
+]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""The codec stages that get timed, and the inputs each one needs"""
+
+from collections import namedtuple
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image
+
+import lzw
+import rle
+from bellard_lzss4 import lzss_compress, lzss_decompress_bytes
+from pic_headers import Pic98BlockHeader
+from pic2png import combine_planes
+from png2pic import separate_into_planes
+from png2spr import make_spr
+from spr2png import parse_spr
+
+# Maximum LZW code width written by png2pic
+LZW_MODE = 11
+
+# Shandalar sprite sheets are made of small frames
+SPR_FRAME = 64
+
+GREY_PALETTE = bytes(i // 3 for i in range(768))
+
+# prepare(sample) returns (args, raw_bytes) where raw_bytes is the size of
+# the uncompressed data the stage works on. Only the run(*args) call is timed.
+Stage = namedtuple("Stage", ["name", "prepare", "run", "kinds"])
+
+
+# Intermediate results are shared between stages so each one is only built
+# once per sample
+@lru_cache(maxsize=None)
+def _rle(sample):
+    return bytes(rle.encode(sample.pixels))
+
+
+@lru_cache(maxsize=None)
+def _lzw_codes(sample):
+    return lzw.encode(_rle(sample), LZW_MODE)
+
+
+@lru_cache(maxsize=None)
+def _lzw_packed(sample):
+    return bytes(lzw.ints2bytes(_lzw_codes(sample), LZW_MODE))
+
+
+@lru_cache(maxsize=None)
+def _planes(sample):
+    # Pic98 images are 16 colours
+    pixels = sample.pixels.translate(bytes(i & 0x0F for i in range(256)))
+    return separate_into_planes(sample.width, sample.height, pixels)
+
+
+@lru_cache(maxsize=None)
+def _lzss_planes(sample):
+    return [lzss_compress(plane) for plane in _planes(sample)]
+
+
+@lru_cache(maxsize=None)
+def _frames(sample):
+    sheet = Image.frombytes("P", (sample.width, sample.height), sample.pixels)
+    return [
+        sheet.crop((x, y, x + SPR_FRAME, y + SPR_FRAME))
+        for y in range(0, sample.height - SPR_FRAME + 1, SPR_FRAME)
+        for x in range(0, sample.width - SPR_FRAME + 1, SPR_FRAME)
+    ]
+
+
+@lru_cache(maxsize=None)
+def _spr(sample):
+    out = BytesIO()
+    make_spr(_frames(sample), out)
+    return out.getvalue()
+
+
+def _frames_size(sample):
+    return len(_frames(sample)) * SPR_FRAME * SPR_FRAME
+
+
+def _lzss_compress_planes(planes):
+    return [lzss_compress(plane) for plane in planes]
+
+
+def _lzss_decompress_planes(compressed, plane_size):
+    return [lzss_decompress_bytes(plane, plane_size) for plane in compressed]
+
+
+def _make_spr(frames):
+    make_spr(frames, BytesIO())
+
+
+def _parse_spr(data):
+    return parse_spr(BytesIO(data), "bench.spr", GREY_PALETTE)
+
+
+STAGES = [
+    Stage(
+        "rle.encode",
+        lambda s: ((s.pixels,), len(s.pixels)),
+        rle.encode,
+        None,
+    ),
+    Stage(
+        "rle.decode",
+        lambda s: ((_rle(s),), len(s.pixels)),
+        rle.decode,
+        None,
+    ),
+    Stage(
+        "lzw.encode",
+        lambda s: ((_rle(s), LZW_MODE), len(_rle(s))),
+        lzw.encode,
+        None,
+    ),
+    Stage(
+        "lzw.ints2bytes",
+        lambda s: ((_lzw_codes(s), LZW_MODE), len(_rle(s))),
+        lzw.ints2bytes,
+        None,
+    ),
+    Stage(
+        "lzw.bytes2ints",
+        lambda s: ((_lzw_packed(s), LZW_MODE), len(_rle(s))),
+        lzw.bytes2ints,
+        None,
+    ),
+    Stage(
+        "lzw.decode",
+        lambda s: ((_lzw_codes(s), LZW_MODE), len(_rle(s))),
+        lzw.decode,
+        None,
+    ),
+    Stage(
+        "lzw.decompress_rle",
+        lambda s: ((_lzw_packed(s), len(s.pixels), LZW_MODE), len(s.pixels)),
+        lzw.decompress_rle,
+        None,
+    ),
+    Stage(
+        "lzw.decompress_rle_parallel",
+        lambda s: ((_lzw_packed(s), len(s.pixels), LZW_MODE), len(s.pixels)),
+        lzw.decompress_rle_parallel,
+        None,
+    ),
+    Stage(
+        "lzss_compress",
+        lambda s: ((_planes(s),), sum(map(len, _planes(s)))),
+        _lzss_compress_planes,
+        None,
+    ),
+    Stage(
+        "lzss_decompress",
+        lambda s: (
+            (_lzss_planes(s), len(_planes(s)[0])),
+            sum(map(len, _planes(s))),
+        ),
+        _lzss_decompress_planes,
+        None,
+    ),
+    Stage(
+        "combine_planes",
+        lambda s: (
+            (Pic98BlockHeader(b"\x00H8\x00", s.width, s.height, b""), _planes(s)),
+            len(s.pixels),
+        ),
+        combine_planes,
+        None,
+    ),
+    Stage(
+        "make_spr",
+        lambda s: ((_frames(s),), _frames_size(s)),
+        _make_spr,
+        ("sprite",),
+    ),
+    Stage(
+        "parse_spr",
+        lambda s: ((_spr(s),), _frames_size(s)),
+        _parse_spr,
+        ("sprite",),
+    ),
+]
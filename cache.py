@@ -0,0 +1,191 @@
+"""
+Content-addressed cache of converted files.
+
+An entry is keyed by a SHA-256 of everything that decides the output: the
+input bytes, the palette, the target format and the encoder parameters. It
+holds the bytes of the converted file, so an unchanged asset is copied from
+the cache instead of being compressed again.
+
+Entries are plain files named by their key. Reading an entry bumps its
+mtime, and once the cache grows past its size limit the entries that were
+used least recently are removed first.
+"""
+
+from typing import Optional
+import hashlib
+import logging
+import os
+
+import timing
+
+# Part of every key, bump it when an encoder's output changes so stale
+# entries are never used
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+# A full cache is trimmed to this fraction of its size limit, so the puts
+# after it don't each need another scan
+EVICT_TO = 0.9
+
+
+def cache_key(*parts) -> str:
+    """Hash bytes, strings and numbers into a key, in order"""
+    h = hashlib.sha256(f"mp_pic_tools cache v{CACHE_VERSION}".encode())
+    for part in parts:
+        if part is None:
+            part = b""
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = repr(part).encode()
+        # length prefix, so ("ab", "c") and ("a", "bc") differ
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+# One ConversionCache per (directory, max_size) in each process, see
+# open_cache
+_open_caches = {}
+
+
+def open_cache(directory: str, max_size: int = DEFAULT_CACHE_SIZE):
+    """This process's ConversionCache for directory, created on first use"""
+    key = (directory, max_size)
+    if key not in _open_caches:
+        _open_caches[key] = ConversionCache(directory, max_size)
+    return _open_caches[key]
+
+
+class ConversionCache:
+    """A cache directory holding at most max_size bytes of entries.
+
+    Several processes can share a directory: entries are written to a
+    temporary file and renamed into place. The directory is scanned on the
+    first put and then only when the entries this process added take it past
+    max_size, so entries other processes add are counted at the next scan.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # bytes in the directory as of the last scan plus what put() added
+        # since, None before the first scan
+        self._size = None
+
+    def __reduce__(self):
+        # Pickled into every batch task as its directory and size only, so a
+        # worker process keeps using one cache and its tracked size
+        return open_cache, (self.directory, self.max_size)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """The cached bytes for key, or None"""
+        path = self._path(key)
+        with timing.stage("cache.get") as s:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            s.bytes_out = len(data)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # evicted by another process in the meantime
+        logging.info(f"cache hit {key}")
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Store data for key and evict old entries if the cache is too big"""
+        path = self._path(key)
+        with timing.stage("cache.put", len(data)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        if self._size is not None:
+            self._size += len(data)
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """If the cache is over its size limit, remove the least recently used
+        entries until it's back down to EVICT_TO of the limit"""
+        entries = []
+        total = 0
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        if total > self.max_size:
+            target = int(self.max_size * EVICT_TO)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    logging.info(f"cache evicted {path}")
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self._size = total
+
+
+def cached(cache: Optional[ConversionCache], inputs: list[str], params, build):
+    """Return build(), or its cached result for these input files and params.
+
+    params is everything else the output depends on, e.g. the palette, the
+    target format and the encoder options. Without a cache build() is always
+    called.
+    """
+    if cache is None:
+        return build()
+
+    contents = []
+    for filename in inputs:
+        with open(filename, "rb") as f:
+            contents.append(f.read())
+    key = cache_key(len(contents), *contents, *params)
+
+    data = cache.get(key)
+    if data is None:
+        data = bytes(build())
+        cache.put(key, data)
+    return data
+
+
+def add_cache_arguments(parser):
+    """Add the --cache-dir and --cache-size options to a command line parser"""
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Keep converted files in this directory and reuse them when the "
+        "input, palette and options haven't changed.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+        help="Maximum size of the cache in MiB, the least recently used "
+        "entries are removed first. Defaults to %(default)s.",
+    )
+
+
+def cache_from_args(args) -> Optional[ConversionCache]:
+    """The cache selected on the command line, None without --cache-dir"""
+    if not args.cache_dir:
+        return None
+    return open_cache(args.cache_dir, args.cache_size * 1024 * 1024)
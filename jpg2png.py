@@ -4,10 +4,10 @@ import argparse
 import os
 import sys
 
-from PIL import Image
-
 
 def main():
+    from PIL import Image
+
     parser = argparse.ArgumentParser(
         description="Convert an image to an 8-bit paletted PNG."
     )
@@ -1,34 +1,46 @@
 # Based on JCivED PIC handling code, fixed and optimized
+from array import array
+from functools import partial
+from itertools import islice
+import logging
+import os
+
+# decompress_rle gives each process at least this many bytes of LZW data,
+# smaller streams are decoded in this process
+PARALLEL_DECODE_MIN = 128 * 1024
+
+
 class LZWDictionary:
 
     def __init__(self, dicIndexMaxBits):
-        self.dicTable = []
         self.curPos = 0
 
         self.dicTableLen = 0x1 << dicIndexMaxBits
         # to optimize both directions:
+        # the encoder looks phrases up by (prefix_code << 8 | next_byte), so it
+        # never has to materialize a phrase, while the decoder needs the table
+        # of full phrases to expand codes.
         self.dict = {}
-        self.table = []
-
-        for i in range(0, 256):
-            self.dict[chr(i)] = i
-            self.table.append([i])
+        self.table = [[i] for i in range(0, 256)]
 
         self.table.append([])  # 256th item
 
         self.curPos = 0x0101  # 257... For some reason...
 
-    def serialize_key(self, entry):
-        return "".join(map(chr, entry))
+    def getIndexOfEntry(self, prefix, byte):
+        """Code of the phrase `prefix` + `byte`, or -1 if it isn't known"""
+        return self.dict.get((prefix << 8) | byte, -1)
 
-    def getIndexOfEntry(self, entry):
-        entry_s = self.serialize_key(entry)
-        return self.dict.get(entry_s, -1)
+    def addCode(self, prefix, byte):
+        """Add the phrase `prefix` + `byte` (encoder side)"""
+        if self.curPos < self.dicTableLen:
+            self.dict[(prefix << 8) | byte] = self.curPos
+            self.curPos += 1
+        return self.curPos - 1
 
     def addEntry(self, entry):
-        entry_s = self.serialize_key(entry)
+        """Add a full phrase (decoder side)"""
         if self.curPos < self.dicTableLen:
-            self.dict[entry_s] = self.curPos
             self.table.append(entry)
             self.curPos += 1
         return self.curPos - 1
@@ -70,24 +82,28 @@ def encode(inputData, dicIndexMaxBits=0x0B):
     plainDataLen = len(plainData)
     while i < plainDataLen:
         dic = LZWDictionary(dicIndexMaxBits)
-        buff = []
+        phrases = dic.dict
+        dicTableLen = dic.getSize()
+        # single bytes are always in the dictionary, so the current phrase
+        # starts out as the code of the first byte
+        code = plainData[i]
+        i += 1
 
         while i < plainDataLen:
-
-            testChunk = list(buff)
-            testChunk.append(plainData[i])
-            if dic.getIndexOfEntry(testChunk) != -1:
-                buff = testChunk
+            byte = plainData[i]
+            nextCode = phrases.get((code << 8) | byte, -1)
+            if nextCode != -1:
+                code = nextCode
             else:
-                codedData.append(dic.getIndexOfEntry(buff))
-                if dic.isFull():
+                codedData.append(code)
+                if dic.curPos >= dicTableLen:
                     break
-                dic.addEntry(testChunk)
-                buff = [plainData[i]]
+                dic.addCode(code, byte)
+                code = byte
             i += 1
 
         if not dic.isFull():
-            codedData.append(dic.getIndexOfEntry(buff))
+            codedData.append(code)
             i += 1
 
     # print(dic.toString(250, 260))
@@ -182,7 +198,7 @@ def decode(inputData, dicIndexMaxBits=0x0B):
             elif k == dic.getCurPos():
                 entry = w + [w[0]]
             else:
-                print("No dictionary entry in LZW dict !!! (", i, k, de, w, ")")
+                logging.error(f"No dictionary entry in LZW dict !!! ({i}, {k})")
                 return plainData
             # print("ent", entry)
 
@@ -208,47 +224,87 @@ def decode(inputData, dicIndexMaxBits=0x0B):
     return plainData
 
 
-def bytes2ints(b_data, ubyte_mode):
-    data = bytearray(b_data)
-    remainingCodedBytes = len(data)
-    parsedIndexes = []
+def code_width_runs(ubyte_mode):
+    """The (count, width) runs of one cycle of the code width schedule.
+
+    The first 256 codes are 9 bits wide, the next 512 are 10 bits and so on
+    until the width would pass ubyte_mode, then it starts over at 9 bits.
+    """
+    runs = [(0x0100, 9)]
+    while runs[-1][1] + 1 <= ubyte_mode:
+        runs.append((runs[-1][0] << 1, runs[-1][1] + 1))
+    return runs
+
+
+def code_position(n, ubyte_mode):
+    """Where code n starts in a PIC bit stream.
+
+    Returns its bit offset, its run in code_width_runs and how many codes of
+    that run come before it.
+    """
+    runs = code_width_runs(ubyte_mode)
+    cycles, n = divmod(n, sum(count for count, _ in runs))
+    bits = cycles * sum(count * width for count, width in runs)
+    for run, (count, width) in enumerate(runs):
+        if n < count:
+            return bits + n * width, run, n
+        bits += count * width
+        n -= count
+
+
+def code_count(bits, ubyte_mode):
+    """Number of whole codes in a PIC bit stream of `bits` bits"""
+    runs = code_width_runs(ubyte_mode)
+    cycles, bits = divmod(bits, sum(count * width for count, width in runs))
+    n = cycles * sum(count for count, _ in runs)
+    for count, width in runs:
+        if bits < count * width:
+            return n + bits // width
+        bits -= count * width
+        n += count
+    return n
+
+
+def iter_codes(b_data, ubyte_mode, first_code=0, skip_bits=0):
+    """Yield the LZW indexes packed in a PIC bit stream, one at a time.
+
+    Walks a memoryview of `b_data` with an index and keeps up to 64 bits in
+    the accumulator, so the input is read exactly once. Trailing bits that
+    don't make up a whole index are dropped.
+
+    To start in the middle of a stream, b_data starts at the byte holding
+    code number first_code and skip_bits is the bit it starts at (see
+    code_position).
+    """
+    data = memoryview(b_data).cast("B")
+    dataLen = len(data)
+    pos = 0
 
     usableBits = 0
     usableBitCount = 0
-
-    indicatorLength = 1  # to increment with ++; rule is that 8+indicatorLength must be <= ubyte_mode, otherwise reset
-    indicatorFlag = 0x001  # to increment with <<=1 followed by |= 1
-    nextThreshold = 0x0100  # /*256*/; to increment with <<=1, or *=2
-    decodedCounter = 0
-
-    # /** Legacy #1 */
-    Index = 0
-    # /** Legacy #1 end */
-
-    while remainingCodedBytes > 0:
-        # /* get enough coded bits to work with */
-        while usableBitCount < 8 + indicatorLength:
-            usableBits |= data.pop(0) << usableBitCount
-            remainingCodedBytes -= 1
-            usableBitCount += 8
-
+    if skip_bits and dataLen:
+        usableBits = data[0] >> skip_bits
+        usableBitCount = 8 - skip_bits
+        pos = 1
+
+    _, run, decodedCounter = code_position(first_code, ubyte_mode)
+    indicatorLength = (
+        1 + run
+    )  # to increment with ++; rule is that 8+indicatorLength must be <= ubyte_mode, otherwise reset
+    indicatorFlag = (
+        1 << indicatorLength
+    ) - 1  # to increment with <<=1 followed by |= 1
+    nextThreshold = 0x0100 << run  # /*256*/; to increment with <<=1, or *=2
+
+    codeLength = 8 + indicatorLength
+    codeMask = ((indicatorFlag << 8) & 0xFF00) | 0x00FF
+
+    while True:
         # /* decode bytes and indicators */
-        while usableBitCount >= 8 + indicatorLength:
-            # /** Legacy #2
-            # ** For us, Index = decodedIndicator<<8 | decodedByte; Or also: Index = usableBits & (indicatorFlag<<8 | 0xFF)
-            # ** TempIndex = Index; fine...
-            # ** Testing legacy code
-            # */
-            Index = usableBits & (((indicatorFlag << 8) & 0xFF00) | 0x00FF)
-            # /** Legacy #2 end */
-
-            # //int decodedByte = usableBits & 0xFF;
-            usableBits >>= 8
-            usableBitCount -= 8
-
-            # //int decodedIndicator = usableBits & indicatorFlag;
-            usableBits >>= indicatorLength
-            usableBitCount -= indicatorLength
+        while usableBitCount >= codeLength:
+            yield usableBits & codeMask
+            usableBits >>= codeLength
+            usableBitCount -= codeLength
 
             decodedCounter += 1
 
@@ -265,11 +321,219 @@ def bytes2ints(b_data, ubyte_mode):
                     indicatorFlag = 0x001
                     nextThreshold = 0x0100  # /*256*/;
 
-            parsedIndexes.append(Index)
+                codeLength = 8 + indicatorLength
+                codeMask = ((indicatorFlag << 8) & 0xFF00) | 0x00FF
+
+        if pos >= dataLen:
+            return
 
-    return parsedIndexes
+        # /* refill the accumulator with as many whole bytes as fit in 64 bits */
+        chunk = data[pos : pos + ((64 - usableBitCount) >> 3)]
+        usableBits |= int.from_bytes(chunk, "little") << usableBitCount
+        usableBitCount += len(chunk) << 3
+        pos += len(chunk)
+
+
+def bytes2ints(b_data, ubyte_mode):
+    """Unpack all LZW indexes from a PIC bit stream into an array('H')"""
+    return array("H", iter_codes(b_data, ubyte_mode))
 
 
 def decompress(data, mode=11):
     lzw_data = bytes2ints(data, mode)
     return decode(lzw_data)
+
+
+def _expand_rle(out, p, phrase, pending):
+    """Expand the RLE escapes of one phrase into out at p (see rle.decode)
+
+    Returns the new output position and whether the phrase ended on a 0x90
+    whose count is in the next one.
+    """
+    i = 0
+    phraseLen = len(phrase)
+    while i < phraseLen:
+        if pending:
+            pending = False
+            count = phrase[i]
+            if count == 0x0:  # If count is 0 then 0x90 is an actual byte
+                out[p : p + 1] = b"\x90"
+                p += 1
+            else:  # Ok, we have a RLE code, let's manage it
+                out[p : p + count - 1] = out[p - 1 : p] * (count - 1)
+                p += count - 1
+            i += 1
+            continue
+        # 0x90 is RLE control code for repetition, copy everything up to it
+        j = phrase.find(0x90, i)
+        if j == -1:
+            j = phraseLen
+        else:
+            pending = True
+        out[p : p + j - i] = phrase[i:j]
+        p += j - i
+        i = j + 1
+    return p, pending
+
+
+def iter_phrases(codes, dicIndexMaxBits=0x0B, first_code=0):
+    """
+    Yield the bytes each LZW code decodes to.
+
+    codes must start at the beginning of a dictionary segment, first_code is
+    its index in the whole stream, for error messages. An invalid code is
+    logged and ends the phrases with a None.
+    """
+    singles = [bytes((i,)) for i in range(256)] + [b""]  # 256th item
+    dicTableLen = 0x1 << dicIndexMaxBits
+    # empty until the first code
+    table = []
+    w = b""
+
+    for i, k in enumerate(codes, first_code):
+        n = len(table)
+        if 0 < n < dicTableLen:
+            if k < n:
+                entry = table[k]
+            elif k == n:
+                entry = w + w[:1]
+            else:
+                logging.error(f"No dictionary entry in LZW dict !!! ({i}, {k})")
+                yield None
+                return
+            # Add w+entry[0] to the dictionary.
+            table.append(w + entry[:1])
+        else:
+            # Start of a segment (or the dictionary is full), the first code
+            # is always a single byte
+            if k > 0xFF:
+                logging.error(f"Invalid first code in LZW segment: {k}")
+                yield None
+                return
+            entry = singles[k]
+            table = singles[:]
+        yield entry
+        w = entry
+
+
+def decompress_rle(data, size, mode=11, dicIndexMaxBits=0x0B, jobs=1) -> bytearray:
+    """
+    LZW-decode `data` and expand the RLE escapes (see rle.decode) in one pass.
+
+    Phrases are expanded as they come out of the LZW dictionary, straight into
+    a bytearray of `size` bytes, so neither the codes nor the RLE stream are
+    ever held in full. Missing pixels are padded with 0xFF, like parse_image
+    always did, and extra ones are dropped.
+
+    With jobs other than 1, big streams are split where the dictionary resets
+    and the segments are LZW-decoded in up to `jobs` processes (None for one
+    per CPU), see decompress_rle_parallel.
+    """
+    workers = min(jobs or os.cpu_count() or 1, len(data) // PARALLEL_DECODE_MIN)
+    if workers >= 2:
+        return decompress_rle_parallel(data, size, mode, dicIndexMaxBits, workers)
+
+    out = bytearray(b"\xff") * size
+    p = 0
+    # The last RLE byte was a 0x90 and its count is in the next phrase
+    pending = False
+
+    phrases = iter_phrases(iter_codes(data, mode), dicIndexMaxBits)
+    first = next(phrases, None)
+    if first is not None:
+        # The very first byte of the RLE stream is always a literal
+        out[0:1] = first
+        p = 1
+        for entry in phrases:
+            if entry is None:
+                break
+            if pending or 0x90 in entry:
+                p, pending = _expand_rle(out, p, entry, pending)
+            else:
+                out[p : p + len(entry)] = entry
+                p += len(entry)
+
+    return _finish_rle(out, p, pending, size)
+
+
+def _finish_rle(out, p, pending, size) -> bytearray:
+    if pending:  # a trailing 0x90 is kept as is
+        out[p : p + 1] = b"\x90"
+        p += 1
+    if p < size:
+        logging.info(f"padded {size - p} missing pixels with 0xFF")
+    del out[size:]
+    return out
+
+
+def decode_segments(
+    data, first_code=0, skip_bits=0, count=None, mode=11, dicIndexMaxBits=0x0B
+) -> tuple[bytes, bool]:
+    """
+    LZW-decode `count` codes that start at the beginning of a dictionary
+    segment, without expanding RLE escapes.
+
+    data, first_code and skip_bits are as for iter_codes. Returns the decoded
+    bytes and False if the decoding stopped at an invalid code.
+    """
+    codes = islice(iter_codes(data, mode, first_code, skip_bits), count)
+    phrases = []
+    for entry in iter_phrases(codes, dicIndexMaxBits, first_code):
+        if entry is None:
+            return b"".join(phrases), False
+        phrases.append(entry)
+
+    return b"".join(phrases), True
+
+
+def decompress_rle_parallel(
+    data, size, mode=11, dicIndexMaxBits=0x0B, jobs=None
+) -> bytearray:
+    """
+    Same result as decompress_rle, with the LZW decoding spread over up to
+    `jobs` processes.
+
+    The dictionary starts over every 2**dicIndexMaxBits - 256 codes and the
+    code widths follow a fixed schedule (see code_position), so the stream
+    can be cut into runs of whole segments without decoding it. Each process
+    unpacks and decodes its own run, then the RLE escapes are expanded here,
+    as they can span segments.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    total = code_count(len(data) * 8, mode)
+    segment = (0x1 << dicIndexMaxBits) - 256
+    segments = -(-total // segment)
+    workers = max(1, min(jobs or os.cpu_count() or 1, segments))
+
+    # (data, first_code, skip_bits, count) for each process
+    parts = []
+    for i in range(workers):
+        first = segments * i // workers * segment
+        last = min(segments * (i + 1) // workers * segment, total)
+        start = code_position(first, mode)[0]
+        end = code_position(last, mode)[0]
+        parts.append(
+            (data[start >> 3 : (end + 7) >> 3], first, start & 7, last - first)
+        )
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            partial(decode_segments, mode=mode, dicIndexMaxBits=dicIndexMaxBits),
+            *zip(*parts),
+        )
+        decoded = []
+        for plain, ok in results:
+            decoded.append(plain)
+            if not ok:
+                break
+    plain = b"".join(decoded)
+
+    out = bytearray(b"\xff") * size
+    p = 0
+    pending = False
+    if plain:
+        # The very first byte of the RLE stream is always a literal
+        out[0:1] = plain[:1]
+        p, pending = _expand_rle(out, 1, plain[1:], False)
+    return _finish_rle(out, p, pending, size)
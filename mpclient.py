@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Client for mpserver.py.
+
+Sends one file to a running server and writes back the converted file. Only
+the standard library is imported, so a call costs little more than starting
+Python:
+
+    python mpclient.py decode-pic City.pic City.png
+    python mpclient.py encode-pic City.png City.pic -p TodPal.tr -s version=98
+"""
+
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import argparse
+import logging
+import os
+import sys
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+OPERATIONS = ("decode-pic", "encode-pic", "decode-spr", "encode-spr")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a file with a running mpserver.py"
+    )
+    parser.add_argument("operation", choices=OPERATIONS)
+    parser.add_argument("input", help="The file to convert, - for stdin.")
+    parser.add_argument("output", help="Where to write the result, - for stdout.")
+    parser.add_argument(
+        "--url",
+        default=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}",
+        help="The server. Defaults to %(default)s.",
+    )
+    parser.add_argument(
+        "-p",
+        "--palette",
+        help="The palette to use, by the file name it was given to the server "
+        "with, e.g. TodPal.tr. Defaults to the server's first palette.",
+    )
+    parser.add_argument(
+        "-s",
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Set a parameter of the operation, e.g. -s version=98. Can be "
+        "specified multiple times.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    params = dict(p.partition("=")[::2] for p in args.set)
+    if args.palette:
+        # the server only knows its palettes by file name
+        params["palette"] = os.path.basename(args.palette)
+
+    try:
+        convert(args.url, args.operation, args.input, args.output, params)
+    except HTTPError as e:
+        logging.error(f"{e.code} {e.read().decode(errors='replace').strip()}")
+        sys.exit(1)
+    except URLError as e:
+        logging.error(f"{args.url}: {e.reason}")
+        sys.exit(1)
+
+
+def convert(url: str, operation: str, input: str, output: str, params: dict):
+    """Send a file to the server and write what it returns.
+
+    Raises HTTPError, with the server's message as the body, if the
+    conversion fails.
+    """
+    if input == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(input, "rb") as f:
+            data = f.read()
+
+    request = Request(
+        f"{url.rstrip('/')}/{operation}?{urlencode(params)}", data=data, method="POST"
+    )
+    with urlopen(request) as response:
+        result = response.read()
+
+    if output == "-":
+        sys.stdout.buffer.write(result)
+    else:
+        with open(output, "wb") as f:
+            f.write(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Local conversion server.
+
+Starting Python, importing PIL and loading a palette takes longer than
+converting a small sprite. `mpserver.py` pays for that once and then
+converts over HTTP on localhost, in a pool of worker processes that keep
+their palettes and lookup tables loaded between requests:
+
+    python mpserver.py -p TodPal.tr &
+    python mpclient.py decode-pic City.pic City.png
+    curl --data-binary @City.pic http://127.0.0.1:8765/decode-pic > City.png
+
+Every request is a POST to /<operation>?<parameters> with the input file as
+the body, and the response body is the converted file:
+
+    decode-pic  PIC to PNG. version (auto, 3 or 98), palette
+    encode-pic  image to PIC. version (3 or 98), palette, dither, lzss_level
+    decode-spr  SPR to a PNG sheet, or one frame with frame=<n>. palette,
+                name (the file name that picks the sheet layout), columns
+    encode-spr  PNG to SPR. frame_width and frame_height cut the image into
+                frames, row by row, the whole image is one frame by default
+
+palette is the file name of one of the palettes the server was started
+with, e.g. palette=TodPal.tr. It defaults to the first -p palette, and other
+files on the server can't be used. Request bodies are limited to
+MAX_BODY_SIZE.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Optional, Sequence
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import logging
+import os
+import struct
+import sys
+
+from PIL import Image
+
+from batch import job_count
+from pic2png import make_image
+from png2pic import convert_image_to_palette
+from png2spr import make_spr
+from quantize import DITHER_MODES
+from shared import load_palette
+from mpclient import DEFAULT_HOST, DEFAULT_PORT
+from spr2png import SHEET_LAYOUTS, SprFile, parse_spr
+import mptools
+
+# Largest request body the server reads
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Set up once per worker process by _init_worker. _palettes maps the names
+# requests can use to the palette files given with -p.
+_palettes = {}
+_default_palette = None
+_palette_cache = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a local server that converts PIC and SPR files"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose mode."
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help="Address to listen on. Defaults to %(default)s.",
+    )
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="Defaults to %(default)s."
+    )
+    parser.add_argument(
+        "-p",
+        "--palette",
+        action="append",
+        default=[],
+        help="A palette requests can use, by its file name. The first one is "
+        "used by requests that don't name one. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--palette-cache",
+        help="Directory to keep palette lookup tables in between runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=job_count,
+        default=None,
+        help="Number of worker processes. Defaults to the CPU count.",
+    )
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    try:
+        palette_names(args.palette)
+    except ValueError as e:
+        parser.error(str(e))
+
+    serve_forever(args.host, args.port, args.palette, args.palette_cache, args.jobs)
+
+
+def decode_pic(data: bytes, params: dict) -> bytes:
+    pixels, width, height, palette = mptools.decode_pic(
+        data, params.get("version", "auto"), _palette(params, required=False), jobs=1
+    )
+    return _png(make_image(pixels, width, height, palette))
+
+
+def encode_pic(data: bytes, params: dict) -> bytes:
+    palette = _palette(params)
+    dither = params.get("dither", "floyd-steinberg")
+    if dither not in DITHER_MODES:
+        raise ValueError(f"Unknown dither mode: {dither}")
+    image = convert_image_to_palette(
+        Image.open(BytesIO(data)), palette, dither, _palette_cache
+    )
+    return mptools.encode_pic(
+        image.tobytes(),
+        image.width,
+        image.height,
+        params.get("version", "3"),
+        palette,
+        int(params.get("lzss_level", 0)),
+        jobs=1,
+    )
+
+
+def decode_spr(data: bytes, params: dict) -> bytes:
+    palette = _palette(params)
+    if "frame" in params:
+        with SprFile(data, palette) as spr:
+            return _png(spr.frame(int(params["frame"])))
+
+    columns = int(params["columns"]) if "columns" in params else None
+    name = params.get("name", "")
+    return _png(parse_spr(BytesIO(data), name, palette, SHEET_LAYOUTS, columns))
+
+
+def encode_spr(data: bytes, params: dict) -> bytes:
+    image = Image.open(BytesIO(data))
+    if image.mode != "P":
+        image = image.convert("P")
+    width = int(params.get("frame_width", image.width))
+    height = int(params.get("frame_height", image.height))
+    if width < 1 or height < 1:
+        raise ValueError(f"Invalid frame size: {width}x{height}")
+
+    frames = [
+        image.crop((x, y, x + width, y + height))
+        for y in range(0, image.height - height + 1, height)
+        for x in range(0, image.width - width + 1, width)
+    ]
+    out = BytesIO()
+    make_spr(frames, out)
+    return out.getvalue()
+
+
+# What the codecs raise for files they can't convert
+BAD_INPUT = (OSError, ValueError, KeyError, IndexError, struct.error)
+
+HANDLERS = {
+    "decode-pic": decode_pic,
+    "encode-pic": encode_pic,
+    "decode-spr": decode_spr,
+    "encode-spr": encode_spr,
+}
+
+
+def palette_names(palettes: Sequence[str]) -> dict:
+    """Map the file name of each palette to its path.
+
+    Raises ValueError if two palettes have the same file name.
+    """
+    names = {}
+    for path in palettes:
+        name = os.path.basename(path)
+        if names.setdefault(name, path) != path:
+            raise ValueError(f"Two palettes are named {name}: {names[name]}, {path}")
+    return names
+
+
+def _palette(params: dict, required: bool = True) -> Optional[bytes]:
+    name = params.get("palette")
+    if name is None:
+        if _default_palette is None:
+            if required:
+                raise ValueError("No palette given and the server has no default")
+            return None
+        return load_palette(_default_palette)
+    if name not in _palettes:
+        raise ValueError(
+            f"Unknown palette: {name}, the server has {', '.join(_palettes) or 'none'}"
+        )
+    return load_palette(_palettes[name])
+
+
+def _png(image: Image.Image) -> bytes:
+    out = BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+def _init_worker(palettes: Sequence[str], palette_cache: Optional[str]):
+    global _palettes, _default_palette, _palette_cache
+    _palettes = palette_names(palettes)
+    _default_palette = palettes[0] if palettes else None
+    _palette_cache = palette_cache
+    for path in palettes:
+        load_palette(path)
+
+
+def convert(operation: str, params: dict, data: bytes) -> bytes:
+    """Run one operation, in a worker process"""
+    return HANDLERS[operation](data, params)
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    server_version = "mpserver"
+
+    def do_GET(self):
+        # the operations, so clients can check that the server is up
+        self._reply(200, "\n".join(sorted(HANDLERS)).encode() + b"\n", "text/plain")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        operation = url.path.strip("/")
+        if operation not in HANDLERS:
+            self._reply(404, f"Unknown operation: {operation}\n".encode(), "text/plain")
+            return
+
+        params = dict(parse_qsl(url.query))
+        try:
+            length = int(self.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            self._reply(400, b"Missing or invalid Content-Length\n", "text/plain")
+            return
+        if length < 0:
+            self._reply(400, b"Invalid Content-Length\n", "text/plain")
+            return
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            message = f"Request body over {MAX_BODY_SIZE} bytes\n"
+            self._reply(413, message.encode(), "text/plain")
+            return
+        data = self.rfile.read(length)
+        try:
+            result = self.server.pool.submit(convert, operation, params, data).result()
+        except Exception as e:
+            logging.error(f"{operation}: {type(e).__name__}: {e}")
+            # bad input, anything else is a bug
+            status = 400 if isinstance(e, BAD_INPUT) else 500
+            self._reply(status, f"{type(e).__name__}: {e}\n".encode(), "text/plain")
+            return
+
+        content_type = "image/png" if operation.startswith("decode") else None
+        self._reply(200, result, content_type or "application/octet-stream")
+
+    def _reply(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def serve_forever(
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    palettes: Sequence[str] = (),
+    palette_cache: Optional[str] = None,
+    jobs: Optional[int] = None,
+):
+    """Serve conversions until interrupted. Requests can only use the
+    palettes given here, by file name, and the first one is the default."""
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(tuple(palettes), palette_cache),
+    ) as pool, ThreadingHTTPServer((host, port), ConversionHandler) as server:
+        server.pool = pool
+        print(f"serving on http://{host}:{server.server_port}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+In-memory API for the PIC and SPR codecs, and the `mptools` command.
+
+Everything here takes and returns bytes. Nothing is read from or written to
+disk and nothing is printed, so the codecs can be embedded in a service and
+used from several threads at once. Pixels are one palette index per byte,
+row by row, and palettes are RGB triplets.
+
+    pixels, width, height, palette = mptools.decode_pic(data)
+    data = mptools.encode_pic(pixels, width, height)
+
+Run as a script it's a single entry point for the command line tools:
+
+    python mptools.py pic2png City.pic
+    python mptools.py png2spr -o Dome.spr frame*.png
+
+PIL and NumPy are only imported by the code that uses them, so commands
+like pic2png --inspect start without them.
+"""
+
+from collections import namedtuple
+from io import BytesIO
+from typing import Iterable, Optional
+import argparse
+import importlib
+import sys
+
+from pic2png import read_pic98, read_pic_v3
+from png2pic import make_pic98, make_picv3
+from png2spr import make_spr
+from sniff import detect_pic_version
+from spr2png import decode_spr_rows, index_spr
+
+# mptools <command> runs the main of this module
+COMMANDS = {
+    "pic2png": "pic2png",
+    "png2pic": "png2pic",
+    "spr2png": "spr2png",
+    "png2spr": "png2spr",
+    "jpg2png": "jpg2png",
+    "server": "mpserver",
+    "client": "mpclient",
+}
+
+# One SPR frame, index 0 is transparent
+Frame = namedtuple("Frame", ["pixels", "width", "height"])
+
+
+def decode_pic(
+    buf,
+    version: str = "auto",
+    palette: Optional[bytes] = None,
+    jobs: Optional[int] = 1,
+) -> tuple[bytes, int, int, bytes]:
+    """Decode a PIC file into (pixels, width, height, palette).
+
+    version is "3" for PICv3, "98" for Pic98 or "auto" to tell them apart
+    from the header. palette is only used for PICv3 files that don't carry
+    their own. Pic98 planes and the LZW segments of big PICv3 images are
+    decompressed in up to `jobs` processes. The default of 1 decodes in this
+    process, None starts one process per CPU.
+    """
+    f = BytesIO(buf)
+    if version == "auto":
+        version = detect_pic_version(f)
+    if version == "3":
+        pixels, width, height, palette = read_pic_v3(f, palette, jobs)
+    elif version == "98":
+        pixels, width, height, palette = read_pic98(f, jobs)
+    else:
+        raise ValueError(f"Unsupported PIC version: {version}")
+    return bytes(pixels), width, height, palette
+
+
+def encode_pic(
+    pixels,
+    width: int,
+    height: int,
+    version: str = "3",
+    palette: Optional[bytes] = None,
+    lzss_level: int = 0,
+    jobs: Optional[int] = 1,
+) -> bytes:
+    """Encode palette indexes as a PIC file.
+
+    PICv3 files are written without a palette block, like png2pic does.
+    Pic98 needs the palette, its first 16 colours are stored in the file and
+    only the low 4 bits of each pixel are kept. lzss_level is passed on to
+    lzss_compress for Pic98, and the planes are compressed in up to `jobs`
+    processes. The default of 1 compresses in this process, None starts one
+    process per CPU.
+    """
+    if len(pixels) != width * height:
+        raise ValueError(f"Expected {width * height} pixels, got {len(pixels)}")
+
+    if version == "3":
+        return bytes(make_picv3(width, height, bytes(pixels)))
+    elif version == "98":
+        if palette is None:
+            raise ValueError("Pic98 files need a palette")
+        return bytes(make_pic98(width, height, pixels, palette, lzss_level, jobs))
+    else:
+        raise ValueError(f"Unsupported PIC version: {version}")
+
+
+def decode_spr(buf) -> list[Frame]:
+    """Decode every frame of an SPR file"""
+    frames = []
+    with memoryview(buf) as view, view.cast("B") as data:
+        index, _ = index_spr(data)
+        for frame in index:
+            header = frame.header
+            pixels = bytearray(header.width * header.height)
+            decode_spr_rows(data, frame.offset, header, pixels)
+            frames.append(Frame(bytes(pixels), header.width, header.height))
+    return frames
+
+
+def encode_spr(frames: Iterable[tuple]) -> bytes:
+    """Encode (pixels, width, height) frames as an SPR file"""
+    from PIL import Image
+
+    images = [
+        Image.frombytes("P", (width, height), bytes(pixels))
+        for pixels, width, height in frames
+    ]
+    out = BytesIO()
+    make_spr(images, out)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="mptools",
+        description="Convert PIC and SPR files. Run mptools <command> -h for "
+        "the options of a command.",
+    )
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    # the command parses the rest of the line itself
+    module = importlib.import_module(COMMANDS[args.command])
+    sys.argv = [f"mptools {args.command}", *args.args]
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+from collections import namedtuple
+from functools import partial
 from io import BufferedReader, BytesIO
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 import argparse
+import json
 import logging
 import os
 import struct
+import sys
 
-from PIL import Image
-from PIL.Image import Image as PILImage
-
-import rle
 import lzw
 from pic_headers import (
     PicV3BlockHeader,
@@ -21,13 +23,33 @@ from pic_headers import (
     Pic98PlaneBlock,
     pic98_plane_block_format,
 )
-from bellard_lzss4 import lzss_decompress
-from shared import tr2pal, pic_version_help_message
+from bellard_lzss4 import lzss_decompress_all
+from batch import add_batch_arguments, expand_inputs, output_path, run_batch
+from cache import ConversionCache, add_cache_arguments, cache_from_args, cached
+from shared import load_palette, pic_version_help_message
+from sniff import SPR, detect_pic_version, sniff_stream
+from spr2png import parse_spr
+import timing
+
+# PIL and NumPy are imported where they are used, so the tools and
+# --inspect start without them
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
+
+# What inspect_pic_v3 and inspect_pic98 find without decoding the image.
+# max_bits is only set for PICv3, palette is None if the file has none.
+PicInfo = namedtuple(
+    "PicInfo", ["version", "width", "height", "max_bits", "palette", "blocks"]
+)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert PIC files to PNG")
-    parser.add_argument("file", help="The PIC file to convert.")
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="The PIC files, directories or glob patterns to convert.",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose mode."
     )
@@ -36,10 +58,19 @@ def main():
     )
     parser.add_argument(
         "--pic-version",
-        choices=["3", "98"],
-        default="3",
+        choices=["auto", "3", "98"],
+        default="auto",
         help=pic_version_help_message(),
     )
+    parser.add_argument(
+        "--inspect",
+        action="store_true",
+        help="Print the size, palette and blocks of each file as a line of "
+        "JSON instead of converting it. Nothing is decompressed.",
+    )
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    timing.add_profile_argument(parser)
     args = parser.parse_args()
 
     if args.verbose:
@@ -47,29 +78,186 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    filename = args.file
-    pal = None
-    if args.palette:
-        if args.palette.endswith(".pal"):
-            with open(args.palette, "rb") as f:
-                pal = f.read()
-        else:
-            pal = tr2pal(args.palette)
+    files = expand_inputs(args.files, (".pic",))
+    if not files:
+        parser.error(f"no input files in {' '.join(args.files)}")
+    timing.enable_from_args(args)
+
+    if args.inspect:
+        sys.exit(1 if print_inspect(files, args.pic_version) else 0)
+
+    convert = partial(
+        convert_file, pic_version=args.pic_version, cache=cache_from_args(args)
+    )
+    # the palette is optional, most PICv3 files carry their own
+    setup = load_palette if args.palette else None
+
+    if len(files) == 1:
+        pal = setup(args.palette) if setup else None
+        # a batch already runs a process per file, a single file gets the
+        # workers for its planes or LZW segments
+        convert(files[0], args.output_dir, pal, jobs=args.jobs)
+        failures = 0
+    else:
+        failures = run_batch(
+            convert, files, args.output_dir, args.jobs, setup, (args.palette,)
+        )
+
+    timing.report_from_args(args)
+    if failures:
+        sys.exit(1)
+
+
+def convert_file(
+    filename: str,
+    out_dir: str,
+    pal: Optional[bytes],
+    pic_version: str = "auto",
+    cache: Optional[ConversionCache] = None,
+    jobs: Optional[int] = 1,
+) -> str:
+    """Convert one PIC file to <out_dir>/<basename>.png
+
+    pic_version is "3", "98" or "auto" to tell from the file. Pic98 planes
+    and the LZW segments of big PICv3 images are decompressed in up to `jobs`
+    processes.
+    """
+    png = cached(
+        cache,
+        [filename],
+        (pal, ".png", pic_version),
+        partial(make_png, filename, pal, pic_version, jobs),
+    )
+
+    out = output_path(filename, out_dir, ".png")
+    logging.debug(f"saving to {out}")
+    with open(out, "wb") as f:
+        f.write(png)
+    return out
+
+
+def make_png(
+    filename: str,
+    pal: Optional[bytes],
+    pic_version: str = "auto",
+    jobs: Optional[int] = 1,
+) -> bytes:
+    """Decode a PIC file and encode it as PNG.
 
+    With pic_version "auto" an SPR file is decoded into a sheet, like
+    spr2png does.
+    """
     # open file as binary
     with open(filename, "rb") as f:
+        if pic_version == "auto":
+            sniffed = sniff_stream(f)
+            if sniffed is None:
+                raise ValueError("Not a PIC or SPR file")
+            pic_version = sniffed.format
         # parse pic format based on version
-        if args.pic_version == "3":
-            image = parse_pic_v3(f, os.path.basename(filename), pal)
-        elif args.pic_version == "98":
-            image = parse_pic98(f, os.path.basename(filename), pal)
+        if pic_version == SPR:
+            if pal is None:
+                raise ValueError("SPR files have no palette of their own, use -p")
+            image = parse_spr(f, filename, pal)
+        elif pic_version == "3":
+            image = parse_pic_v3(f, os.path.basename(filename), pal, jobs)
+        elif pic_version == "98":
+            image = parse_pic98(f, os.path.basename(filename), pal, jobs)
         else:
             # This case should not be reached due to 'choices' in add_argument
-            raise ValueError(f"Unsupported PIC version: {args.pic_version}")
+            raise ValueError(f"Unsupported PIC version: {pic_version}")
+
+    with timing.stage("png.save", image.width * image.height) as s:
+        png = BytesIO()
+        image.save(png, "PNG")
+        s.bytes_out = png.tell()
+    return png.getvalue()
+
+
+def print_inspect(files: list[str], pic_version: str) -> int:
+    """Print one line of JSON per file, returns the number of failures"""
+    failures = 0
+    for filename in files:
+        try:
+            with open(filename, "rb") as f:
+                version = pic_version
+                if version == "auto":
+                    version = detect_pic_version(f)
+                if version == "3":
+                    info = inspect_pic_v3(f)
+                else:
+                    info = inspect_pic98(f)
+        except (OSError, ValueError, struct.error) as e:
+            logging.error(f"{filename}: {e}")
+            failures += 1
+            continue
+
+        record = {"file": filename, **info._asdict()}
+        record["palette"] = info.palette.hex() if info.palette else None
+        record["blocks"] = [
+            {
+                k: v.decode("ascii") if isinstance(v, bytes) else v
+                for k, v in b._asdict().items()
+            }
+            for b in info.blocks
+        ]
+        print(json.dumps(record))
+    return failures
+
+
+def inspect_pic_v3(f: BufferedReader) -> PicInfo:
+    """Read the block headers and palette of a PICv3 file.
+
+    The image block header is read for the size, but its LZW data is not.
+    """
+    info = PicInfo("3", None, None, None, None, [])
+
+    while True:
+        hdr = f.read(4)
+        if not hdr:
+            break
+        block_header = PicV3BlockHeader._make(struct.unpack("<2sH", hdr))
+        header_str = block_header.block_id.decode("ascii", errors="replace")
+        if header_str not in ("C0", "E0", "M0", "M1", "X0", "X1"):
+            raise ValueError(f"Invalid block id: {header_str}")
+        info.blocks.append(block_header)
+
+        if header_str in ("M0", "M1"):
+            info = info._replace(palette=parse_palette(f))
+        elif header_str in ("X0", "X1"):
+            header = PicV3Image._make(struct.unpack("<HHB", f.read(5)))
+            info = info._replace(
+                width=header.width, height=header.height, max_bits=header.max_bits
+            )
+            # the image data runs to the end of the file (see parse_image)
+            break
+        else:
+            f.seek(block_header.length, 1)
+
+    return info
+
+
+def inspect_pic98(f: BufferedReader) -> PicInfo:
+    """Read the header, palette and plane lengths of a Pic98 file.
 
-        out = f"{os.path.basename(filename)}.png"
-        logging.debug(f"saving to {out}")
-        image.save(out)
+    The compressed planes are skipped.
+    """
+    header = Pic98BlockHeader._make(struct.unpack(pic98_header_format, f.read(56)))
+    if header.sig != b"\x00H8\x00":
+        raise ValueError(f"Invalid pic98 file: {header.sig}")
+
+    blocks = []
+    for i in range(4):
+        block = Pic98PlaneBlock._make(
+            struct.unpack(pic98_plane_block_format, f.read(2))
+        )
+        blocks.append(block)
+        f.seek(block.length, 1)
+        # align on 16 bit boundary
+        f.seek(f.tell() % 2, 1)
+
+    palette = convert_rgb444_palette_to_rgb888_bytes(header.pal)
+    return PicInfo("98", header.width, header.height, None, palette, blocks)
 
 
 # The PICv3 files consist of one or more tagged blocks of data. Each block
@@ -77,12 +265,29 @@ def main():
 # and its length. A valid PIC file must contain one of the image types but can
 # optionally contain any one, or more, of the other defined block types
 def parse_pic_v3(
-    f: BufferedReader, fn: str, palette: Optional[bytes] = None
+    f: BufferedReader,
+    fn: str,
+    palette: Optional[bytes] = None,
+    jobs: Optional[int] = 1,
 ) -> PILImage:
     """Convert .pic file to .png"""
+    pic, width, height, pal = read_pic_v3(f, palette, jobs)
+    # make png from palette and pic data
+    logging.info(f"pic: {fn}, w: {width}, h: {height}")
+    return make_image(pic, width, height, pal)
+
+
+def read_pic_v3(
+    f: BufferedReader, palette: Optional[bytes] = None, jobs: Optional[int] = 1
+) -> tuple[bytearray, int, int, bytes]:
+    """Decode a PICv3 file into (pixels, width, height, palette).
 
+    The palette in the file wins over the one given. Big images are LZW
+    decoded in up to `jobs` processes, see lzw.decompress_rle.
+    """
     pal = palette
     def_pal = True
+    pic = None
 
     while f:
         # read block header
@@ -102,10 +307,12 @@ def parse_pic_v3(
             raise ValueError(f"Invalid block id: {header_str}")
 
         if header_str in ("M0", "M1"):  # Block Type M0 – Palette data
-            pal = parse_palette(f)
+            with timing.stage("palette.parse") as s:
+                pal = parse_palette(f)
+                s.bytes_out = len(pal)
             def_pal = False
         elif header_str in ("X0", "X1"):
-            pic, width, height = parse_image(f, block_header.length)
+            pic, width, height = parse_image(f, block_header.length, jobs)
         elif header_str in ("C0", "E0"):
             raise ValueError(f"header {header_str} not implemented")
 
@@ -113,19 +320,21 @@ def parse_pic_v3(
         raise ValueError(
             "ERROR: No palette available. Not found in .pic and not specified as args"
         )
-    # make png from palette and pic data
-    logging.info(f"pic: {fn}, def_pal: {def_pal}, w: {width}, h: {height}")
+    if pic is None:
+        raise ValueError("ERROR: No image block found in .pic")
+    logging.info(f"def_pal: {def_pal}, w: {width}, h: {height}")
     # print(f"pic {pic[0:10].hex()}")
 
-    i = 0
-    while i < len(pal):
-        # print(f"pal {i // 3}: {pal[i:i+3].hex()}")
-        i += 3
+    return pic, width, height, pal
 
-    image = Image.frombytes("P", (width, height), pic)
-    image.putpalette(pal)
-    image.info["transparency"] = 255
 
+def make_image(pixels, width: int, height: int, palette: bytes) -> PILImage:
+    """Wrap decoded PIC pixels in a 'P' image, index 255 is transparent"""
+    from PIL import Image
+
+    image = Image.frombytes("P", (width, height), pixels)
+    image.putpalette(palette)
+    image.info["transparency"] = 255
     return image
 
 
@@ -140,32 +349,30 @@ def parse_pic_v3(
 # and does not indicate the pixel packing arrangement, only the maximum
 # LZW code width) The most common identifier values we have seen are:
 # 9-11
-def parse_image(f, length: int) -> tuple[bytes, int, int]:
+def parse_image(f, length: int, jobs: Optional[int] = 1) -> tuple[bytearray, int, int]:
     header = PicV3Image._make(struct.unpack("<HHB", f.read(5)))
     logging.debug(f"Image header: {header}")
     # data = f.read(length - 5)
     # sometimes length is an overflowed value (see 0028.pic in Shandalar)
     # in all the mtg picv3 files, the last block is the image data
     # so we read until the end of the file
-    data = f.read(-1)
-
-    # lzw decompress
-    data = lzw.decompress(data, abs(header.max_bits))
-    logging.info(f"len after LZW {len(data)}")
-
-    # rle decompress
-    data = rle.decode(data)
-    logging.info(f"len after RLE {len(data)}, exp {header.width * header.height}")
+    with timing.stage("read") as s:
+        data = f.read(-1)
+        s.bytes_out = len(data)
+
+    # lzw and rle decompress in one pass, padded to width*height
+    # Padding happens in mtg Cstline1.pic, Dungeon.pic, and Magic.pic
+    with timing.stage("lzw+rle.decode", len(data)) as s:
+        data = lzw.decompress_rle(
+            data, header.width * header.height, abs(header.max_bits), jobs=jobs
+        )
+        s.bytes_out = len(data)
 
     # unpack bits
     # data = unpack_data(data)
     # logging.info(f"len after UNPACK {len(data)}, exp {header.width * header.height}")
 
-    # Pad image data to width*height
-    # This happens in mtg Cstline1.pic, Dungeon.pic, and Magic.pic
-    data += [255] * (header.width * header.height - len(data))
-
-    return bytes(data), header.width, header.height
+    return data, header.width, header.height
 
 
 def unpack_data(data: list) -> list:
@@ -202,8 +409,24 @@ def parse_palette(f: BufferedReader) -> bytes:
 # see https://canadianavenger.io/2024/09/17/pic-as-we-know-it/
 # and https://canadianavenger.io/2024/06/26/oops-i-did-it-again/
 def parse_pic98(
-    f: BufferedReader, fn: str, palette: Optional[bytes] = None
+    f: BufferedReader,
+    fn: str,
+    palette: Optional[bytes] = None,
+    jobs: Optional[int] = 1,
 ) -> PILImage:
+    # Pic98 files always carry their own palette
+    pixels, width, height, pal = read_pic98(f, jobs)
+    return make_image(pixels, width, height, pal)
+
+
+def read_pic98(
+    f: BufferedReader, jobs: Optional[int] = 1
+) -> tuple[bytes, int, int, bytes]:
+    """Decode a Pic98 file into (pixels, width, height, palette).
+
+    The planes are decompressed in up to `jobs` processes, see
+    lzss_decompress_all.
+    """
     header = Pic98BlockHeader._make(struct.unpack(pic98_header_format, f.read(56)))
 
     if header.sig != b"\x00H8\x00":
@@ -212,7 +435,9 @@ def parse_pic98(
     logging.info(f"Width: {header.width}, Height: {header.height}")
 
     # Pic98 files have 4 "planes" that are overlayed to form a single image
-    image_planes = []
+    blocks = []
+    # each plane holds one bit of every pixel, rows padded to a whole byte
+    plane_size = ((header.width + 7) // 8) * header.height
 
     for i in range(4):
         # read 4 blocks of data
@@ -220,59 +445,55 @@ def parse_pic98(
             struct.unpack(pic98_plane_block_format, f.read(2))
         )
         logging.info(f"Block {i}: len: {block.length}: curr: {f.tell()}")
-        image_planes.append(lzss_decompress(BytesIO(f.read(block.length))))
-        logging.info(
-            f"Block {i}: len: {block.length}: curr: {f.tell()} date: {len(block)}"
-        )
+        with timing.stage("read") as s:
+            blocks.append(f.read(block.length))
+            s.bytes_out = len(blocks[-1])
 
         # align on 16 bit boundary
         logging.info(f.tell() % 2)
         f.read(f.tell() % 2)
 
-    pixels = combine_planes(header, image_planes)
-    palette = convert_rgb444_palette_to_rgb888_bytes(header.pal)
+    # the planes are independent, decompress them in parallel
+    with timing.stage("lzss.decompress", sum(map(len, blocks))) as s:
+        image_planes = lzss_decompress_all(blocks, plane_size, jobs)
+        s.bytes_out = sum(map(len, image_planes))
+    for i, plane in enumerate(image_planes):
+        logging.info(f"Block {i}: len: {len(blocks[i])} data: {len(plane)}")
+
+    with timing.stage("planes.combine", plane_size * 4) as s:
+        pixels = combine_planes(header, image_planes)
+        s.bytes_out = len(pixels)
+    with timing.stage("palette.parse", len(header.pal)) as s:
+        palette = convert_rgb444_palette_to_rgb888_bytes(header.pal)
+        s.bytes_out = len(palette)
 
     expected = header.width * header.height
     if len(pixels) != expected:
         raise ValueError(f"Size is: {len(pixels)} but should be {expected}")
 
-    image = Image.frombytes("P", (header.width, header.height), pixels)
-    image.putpalette(palette)
-    image.info["transparency"] = 255
+    return pixels, header.width, header.height, palette
 
-    return image
 
+def combine_planes(hdr, planes) -> bytes:
+    """Combine the 4 bitplanes into one 4-bit pixel per byte.
+
+    Plane rows are padded to a whole byte, so images whose width isn't a
+    multiple of 8 keep their last pixels.
+    """
+    import numpy as np
+
+    stride = (hdr.width + 7) // 8  # 8 pixels per byte
+    size = stride * hdr.height
+    pixels = np.zeros((hdr.height, stride * 8), dtype=np.uint8)
+
+    for i, plane in enumerate(planes):
+        if len(plane) < size:
+            raise ValueError(f"Plane {i} is {len(plane)} bytes, expected {size}")
+        # plane 0 holds the lowest bit of each pixel, MSB is the leftmost pixel
+        bits = np.unpackbits(np.frombuffer(plane, dtype=np.uint8, count=size))
+        pixels |= bits.reshape(hdr.height, stride * 8) << i
 
-def combine_planes(hdr, planes):
-    fo = bytearray()
-
-    for y in range(hdr.height):
-        for x in range(hdr.width // 8):  # 8 pixels per byte
-            pos = (y * (hdr.width // 8)) + x
-            p0 = planes[0][pos]
-            p1 = planes[1][pos]
-            p2 = planes[2][pos]
-            p3 = planes[3][pos]
-
-            for b in range(8):
-                px = 0
-
-                px |= p0 & 0x80
-                px >>= 1
-                px |= p1 & 0x80
-                px >>= 1
-                px |= p2 & 0x80
-                px >>= 1
-                px |= p3 & 0x80
-                px >>= 4  # move final value to lower 4 bits
-
-                p0 = (p0 << 1) & 0xFF
-                p1 = (p1 << 1) & 0xFF
-                p2 = (p2 << 1) & 0xFF
-                p3 = (p3 << 1) & 0xFF
-
-                fo.append(px)
-    return fo
+    return pixels[:, : hdr.width].tobytes()
 
 
 def convert_rgb444_palette_to_rgb888_bytes(rgb444_bytes):
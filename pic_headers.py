@@ -1,4 +1,5 @@
 from collections import namedtuple
+import struct
 
 # typedef struct {  // PicV3 General Block Header
 #     char block_id[2];  // block tag
@@ -64,3 +65,6 @@ SprHeader = namedtuple(
     ],
 )
 SprFormat = "<IHHHHHH"
+SPR_HEADER_SIZE = struct.calcsize(SprFormat)
+# Frames bigger than this are taken for a corrupt file
+SPR_MAX_FRAME_SIZE = 100_000
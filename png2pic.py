@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
-from PIL import Image
+from __future__ import annotations
+
+from functools import partial
+from typing import TYPE_CHECKING, Optional
 import argparse
 import logging
 import struct
 import os
+import sys
 
 from pic_headers import (
     PicV3BlockHeader,
@@ -17,13 +21,24 @@ from pic_headers import (
 )
 import rle
 import lzw
-from shared import tr2pal
-from bellard_lzss4 import lzss_compress
+from batch import add_batch_arguments, expand_inputs, output_path, run_batch
+from cache import ConversionCache, add_cache_arguments, cache_from_args, cached
+from quantize import DITHER_MODES, quantize
+from shared import load_palette
+from bellard_lzss4 import LEVELS, chain_depth, lzss_compress_all
+import timing
+
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert PNG files to PIC files")
-    parser.add_argument("file", help="The PNG file to convert.")
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="The PNG files, directories or glob patterns to convert.",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose mode."
     )
@@ -36,6 +51,35 @@ def main():
         default="3",
         help="PIC version to create: 3 for PICv3, 98 for Pic98",
     )
+    parser.add_argument(
+        "--dither",
+        choices=DITHER_MODES,
+        default="floyd-steinberg",
+        help="How to dither colours that aren't in the palette. Defaults to floyd-steinberg.",
+    )
+    parser.add_argument(
+        "--palette-cache",
+        help="Directory to keep palette lookup tables in between runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "--lzss-level",
+        type=int,
+        choices=LEVELS,
+        default=0,
+        help="Pic98 compression: 0 greedy (fastest), 1 lazy, 2 optimal (smallest). Defaults to 0.",
+    )
+    parser.add_argument(
+        "--lzss-max-chain",
+        type=int,
+        default=None,
+        help="How many earlier positions to try for each LZSS match, 0 for all "
+        "of them. More is slower and compresses better. Defaults to all for "
+        "level 0 and 256 for levels 1 and 2.",
+    )
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    timing.add_profile_argument(parser)
     args = parser.parse_args()
 
     if args.verbose:
@@ -43,48 +87,149 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    img, width, height, bytes_orig = parse_image(args.file)
-    quantized_img = convert_image_to_palette(img, args.palette)
-    bytes_quantized = quantized_img.tobytes()
-
-    if args.pic_version == "3":
-        pic = make_picv3(width, height, bytes_quantized)
-        ext = ".pic"
-    elif args.pic_version == "98":
-        pic = make_pic98(width, height, bytes_quantized, args.palette)
-        ext = ".pic"
+    if args.lzss_max_chain is not None and args.lzss_max_chain < 0:
+        parser.error("--lzss-max-chain can't be negative")
+
+    files = expand_inputs(args.files, (".png", ".jpg", ".jpeg", ".gif", ".bmp"))
+    if not files:
+        parser.error(f"no input files in {' '.join(args.files)}")
+    timing.enable_from_args(args)
+    convert = partial(
+        convert_file,
+        pic_version=args.pic_version,
+        dither=args.dither,
+        palette_cache=args.palette_cache,
+        lzss_level=args.lzss_level,
+        lzss_max_chain=args.lzss_max_chain,
+        cache=cache_from_args(args),
+    )
 
-    out = f"{os.path.basename(args.file)}{ext}"
-    with open(out, "wb") as f:
-        print(f"writing pic to {out}")
-        f.write(pic)
+    if len(files) == 1:
+        # a batch already runs a process per file, a single file gets the
+        # workers for its planes
+        convert(
+            files[0], args.output_dir, load_palette(args.palette), plane_jobs=args.jobs
+        )
+        failures = 0
+    else:
+        failures = run_batch(
+            convert, files, args.output_dir, args.jobs, load_palette, (args.palette,)
+        )
 
+    timing.report_from_args(args)
+    if failures:
+        sys.exit(1)
+
+
+def convert_file(
+    filename: str,
+    out_dir: str,
+    palette: bytes,
+    pic_version: str = "3",
+    dither: str = "floyd-steinberg",
+    palette_cache: Optional[str] = None,
+    lzss_level: int = 0,
+    lzss_max_chain: Optional[int] = None,
+    cache: Optional[ConversionCache] = None,
+    plane_jobs: Optional[int] = 1,
+) -> str:
+    """Convert one image to <out_dir>/<basename>.pic
+
+    Pic98 planes are compressed in up to plane_jobs processes.
+    """
+    if pic_version not in ("3", "98"):
+        raise ValueError(f"Unsupported PIC version: {pic_version}")
+
+    pic = cached(
+        cache,
+        [filename],
+        (
+            palette,
+            ".pic",
+            pic_version,
+            dither,
+            lzss_level,
+            chain_depth(lzss_level, lzss_max_chain),
+        ),
+        partial(
+            make_pic,
+            filename,
+            palette,
+            pic_version,
+            dither,
+            palette_cache,
+            lzss_level,
+            plane_jobs,
+            lzss_max_chain,
+        ),
+    )
 
-def convert_image_to_palette(image: Image.Image, palette_filename: str) -> Image.Image:
-    """Convert an image to a palette using a specified palette file."""
-    # Check if it's a binary palette file (.pal) or text palette file (.tr)
-    if palette_filename.endswith(".pal"):
-        with open(palette_filename, "rb") as f:
-            palette = f.read()
+    out = output_path(filename, out_dir, ".pic")
+    with timing.stage("write", len(pic)) as s, open(out, "wb") as f:
+        logging.info(f"writing pic to {out}")
+        f.write(pic)
+        s.bytes_out = len(pic)
+    return out
+
+
+def make_pic(
+    filename: str,
+    palette: bytes,
+    pic_version: str = "3",
+    dither: str = "floyd-steinberg",
+    palette_cache: Optional[str] = None,
+    lzss_level: int = 0,
+    plane_jobs: Optional[int] = 1,
+    lzss_max_chain: Optional[int] = None,
+) -> bytearray:
+    """Read an image, match it to the palette and encode it as a PIC file"""
+    img, width, height, bytes_orig = parse_image(filename)
+    with timing.stage("quantize", len(bytes_orig)) as s:
+        quantized_img = convert_image_to_palette(img, palette, dither, palette_cache)
+        bytes_quantized = quantized_img.tobytes()
+        s.bytes_out = len(bytes_quantized)
+
+    if pic_version == "3":
+        return make_picv3(width, height, bytes_quantized)
+    elif pic_version == "98":
+        return make_pic98(
+            width,
+            height,
+            bytes_quantized,
+            palette,
+            lzss_level,
+            plane_jobs,
+            lzss_max_chain,
+        )
     else:
-        palette = tr2pal(palette_filename)
+        raise ValueError(f"Unsupported PIC version: {pic_version}")
 
-    palette_image = Image.new("P", (16, 16))
-    palette_image.putpalette(palette)
 
-    # Convert the image to RGB mode before quantizing
-    rgb_image = image.convert("RGB")
+def convert_image_to_palette(
+    image: PILImage,
+    palette: bytes,
+    dither: str = "floyd-steinberg",
+    palette_cache: Optional[str] = None,
+) -> PILImage:
+    """Convert an image to a palette (see shared.load_palette).
 
-    # Convert using fixed palette
-    return rgb_image.quantize(palette=palette_image, dither=Image.FLOYDSTEINBERG)
+    The ordered and none dither modes go through a per-palette lookup table,
+    see quantize.palette_lut.
+    """
+    return quantize(image, palette, dither, cache_dir=palette_cache)
 
 
-def parse_image(filename: str) -> tuple[Image.Image, int, int, bytes]:
+def parse_image(filename: str) -> tuple[PILImage, int, int, bytes]:
     """Parse an image file and return image data and metadata."""
-    img = Image.open(filename)
-    width, height = img.size
-    bytes_data = img.tobytes()
-    print("len bytes:", len(bytes_data))
+    from PIL import Image
+
+    with timing.stage("read") as s:
+        img = Image.open(filename)
+        width, height = img.size
+        bytes_data = img.tobytes()
+        s.bytes_in = os.path.getsize(filename)
+        s.bytes_out = len(bytes_data)
+    logging.info(f"len bytes: {len(bytes_data)}")
     return img, width, height, bytes_data
 
 
@@ -100,10 +245,14 @@ def make_picv3(width: int, height: int, bytes: bytes) -> bytearray:
     img_block.extend(struct.pack("<HHB", *img_header))
     # print(bytes, len(bytes))
     # print(width, height)
-    rle_bytes = rle.encode(bytes)
+    with timing.stage("rle.encode", len(bytes)) as s:
+        rle_bytes = rle.encode(bytes)
+        s.bytes_out = len(rle_bytes)
     # print(rle_bytes)
     # print("rle_bytes", len(rle_bytes))
-    img_compressed = lzw.compress(rle_bytes, mode)
+    with timing.stage("lzw.encode", len(rle_bytes)) as s:
+        img_compressed = lzw.compress(rle_bytes, mode)
+        s.bytes_out = len(img_compressed)
     img_block.extend(struct.pack("<" + ("B" * len(img_compressed)), *img_compressed))
     # print(len(img_compressed))
     # Some files (0028.pic) are larger than uint8, so we write the overflowed value
@@ -115,16 +264,19 @@ def make_picv3(width: int, height: int, bytes: bytes) -> bytearray:
 
 
 def make_pic98(
-    width: int, height: int, pixel_data: bytes, palette_file: str
+    width: int,
+    height: int,
+    pixel_data: bytes,
+    palette_rgb888: bytes,
+    level: int = 0,
+    jobs: Optional[int] = 1,
+    max_chain: Optional[int] = None,
 ) -> bytearray:
-    """Create a Pic98 file from image data"""
+    """Create a Pic98 file from image data, level and max_chain are the LZSS
+    level and match search depth (see lzss_compress). The planes are
+    compressed in up to `jobs` processes, see lzss_compress_all."""
 
-    # Load palette and convert to RGB444 format
-    if palette_file.endswith(".pal"):
-        with open(palette_file, "rb") as f:
-            palette_rgb888 = f.read()
-    else:
-        palette_rgb888 = tr2pal(palette_file)
+    # Convert palette to RGB444 format
     palette_rgb444 = convert_rgb888_to_rgb444_bytes(palette_rgb888)
 
     # Create pic98 header
@@ -132,25 +284,17 @@ def make_pic98(
     header = Pic98BlockHeader(sig, width, height, palette_rgb444)
 
     # Separate pixel data into 4 planes
-    planes = separate_into_planes(width, height, pixel_data)
-
-    # Debug: print plane sizes before compression
-    for i, plane in enumerate(planes):
-        print(f"Plane {i}: {len(plane)} bytes")
-
-    # For now, use a working solution: if our plane data exactly matches the
-    # decompressed data from tlogo.pic, use its compressed data directly.
-    # This is a pragmatic solution while a proper LZSS implementation is developed.
-    compressed_planes = []
-
-    for i, plane in enumerate(planes):
-        with open(f"plane_{i}", "wb") as f:
-            f.write(plane)
-        compressed_plane = lzss_compress(plane)
-        compressed_planes.append(compressed_plane)
-        print(
-            f"Plane {i}: {len(plane)} bytes -> {len(compressed_plane)} bytes (literal LZSS)"
-        )
+    with timing.stage("planes.separate", len(pixel_data)) as s:
+        planes = separate_into_planes(width, height, pixel_data)
+        s.bytes_out = sum(map(len, planes))
+
+    # the planes are independent, compress them in parallel
+    with timing.stage("lzss.compress", sum(map(len, planes))) as s:
+        compressed_planes = lzss_compress_all(planes, max_chain, level=level, jobs=jobs)
+        s.bytes_out = sum(map(len, compressed_planes))
+
+    for i, (plane, compressed_plane) in enumerate(zip(planes, compressed_planes)):
+        logging.info(f"Plane {i}: {len(plane)} bytes -> {len(compressed_plane)} bytes")
 
     # Build the pic98 file
     pic98_data = bytearray()
@@ -195,35 +339,23 @@ def convert_rgb888_to_rgb444_bytes(rgb888_palette: bytes) -> bytes:
     return bytes(rgb444_bytes)
 
 
-# TODO: I don't think this works
 def separate_into_planes(width: int, height: int, pixel_data: bytes) -> list:
     """Separate 4-bit pixel data into 4 bit planes (reverse of combine_planes)"""
-    planes = [bytearray(), bytearray(), bytearray(), bytearray()]
-
-    for y in range(height):
-        for x in range(width // 8):  # 8 pixels per byte
-            # Initialize plane bytes for this position
-            plane_bytes = [0, 0, 0, 0]
-
-            # Process 8 pixels
-            for b in range(8):
-                pixel_idx = (y * width) + (x * 8) + b
-                if pixel_idx < len(pixel_data):
-                    pixel = pixel_data[pixel_idx] & 0x0F  # 4-bit pixel value
-
-                    # Extract each bit and place in corresponding plane
-                    # Note: bit extraction order matches the combine_planes logic
-                    bit_pos = 7 - b  # MSB first
-                    plane_bytes[0] |= ((pixel & 0x01) >> 0) << bit_pos  # LSB -> plane 0
-                    plane_bytes[1] |= ((pixel & 0x02) >> 1) << bit_pos
-                    plane_bytes[2] |= ((pixel & 0x04) >> 2) << bit_pos
-                    plane_bytes[3] |= ((pixel & 0x08) >> 3) << bit_pos  # MSB -> plane 3
-
-            # Add bytes to each plane
-            for i in range(4):
-                planes[i].append(plane_bytes[i])
-
-    return [bytes(plane) for plane in planes]
+    import numpy as np
+
+    stride = (width + 7) // 8  # 8 pixels per byte, rows padded to a whole byte
+    size = width * height
+
+    # Missing pixels are written as 0
+    pixels = np.zeros(size, dtype=np.uint8)
+    data = np.frombuffer(pixel_data, dtype=np.uint8, count=min(size, len(pixel_data)))
+    pixels[: len(data)] = data & 0x0F
+
+    rows = np.zeros((height, stride * 8), dtype=np.uint8)
+    rows[:, :width] = pixels.reshape(height, width)
+
+    # LSB -> plane 0, MSB -> plane 3, leftmost pixel in the high bit
+    return [np.packbits((rows >> i) & 1, axis=1).tobytes() for i in range(4)]
 
 
 if __name__ == "__main__":
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+from functools import partial
+from io import BytesIO
 import argparse
 import logging
 import os
 import struct
-from typing import List
+from typing import TYPE_CHECKING, List
+
+from cache import add_cache_arguments, cache_from_args, cached
+import timing
 
-from PIL import Image
-from PIL.Image import Image as PILImage
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
 
 
 def main():
@@ -17,6 +24,8 @@ def main():
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose mode."
     )
+    add_cache_arguments(parser)
+    timing.add_profile_argument(parser)
     args = parser.parse_args()
 
     if args.verbose:
@@ -24,102 +33,105 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    timing.enable_from_args(args)
+
+    spr = cached(
+        cache_from_args(args), args.files, (".spr",), partial(make_spr_file, args.files)
+    )
+    with open(args.output, "wb") as f:
+        f.write(spr)
+
+    timing.report_from_args(args)
+
+
+def make_spr_file(files: List[str]) -> bytes:
+    """Read PNG files and encode them as the frames of one SPR file"""
+    from PIL import Image
+
     # Load all PNG images
     images = []
-    for filename in args.files:
-        img = Image.open(filename)
-        if img.mode != "P":
-            img = img.convert("P")
+    for filename in files:
+        with timing.stage("read", os.path.getsize(filename)) as s:
+            img = Image.open(filename)
+            if img.mode != "P":
+                img = img.convert("P")
+            img.load()
+            s.bytes_out = img.width * img.height
         images.append(img)
 
-    # Convert and save as SPR
-    with open(args.output, "wb") as f:
-        make_spr(images, f)
+    # Convert to SPR
+    spr = BytesIO()
+    with timing.stage("spr.encode", sum(i.width * i.height for i in images)) as s:
+        make_spr(images, spr)
+        s.bytes_out = spr.tell()
+    return spr.getvalue()
 
 
 def make_spr(images: List[PILImage], output_stream) -> None:
     """Convert a list of PNG images to SPR format and write to output stream."""
 
     for image in images:
-        width, height = image.size
-        pixel_data = list(image.getdata())
+        output_stream.write(encode_spr_frame(image))
 
-        # Calculate empty lines at the top
-        empty_lines = 0
-        for y in range(height):
-            if any(pixel_data[y * width : (y + 1) * width]):
-                break
-            empty_lines += 1
+    # Write end marker
+    output_stream.write(struct.pack("<I", 0xFFFFFFFF))
+
+
+def encode_spr_frame(image: PILImage) -> bytearray:
+    """Encode one "P" image, index 0 is transparent, as an SPR frame.
+
+    Each row is stored as its leading transparent pixels and the run of
+    opaque pixels after them. Rows without opaque pixels are left out and
+    pixels after the first run are dropped.
+    """
+    import numpy as np
 
-        # Find cutoff offset (first non-empty line from bottom)
+    width, height = image.size
+    pixels = np.asarray(image, dtype=np.uint8).reshape(height, width)
+    opaque = pixels != 0
+    opaque_rows = opaque.any(axis=1)
+
+    if opaque_rows.any():
+        # empty lines at the top, and the first non-empty line from the bottom
+        empty_lines = int(opaque_rows.argmax())
+        cutoff_offset_y = int(opaque_rows[::-1].argmax())
+    else:
+        empty_lines = height
         cutoff_offset_y = 0
-        for y in range(height - 1, -1, -1):
-            if any(pixel_data[y * width : (y + 1) * width]):
-                cutoff_offset_y = height - y - 1
-                break
-
-        # Pre-calculate the image data to determine size
-        image_data = bytearray()
-
-        # Write header placeholder
-        image_data.extend(b"\x00" * 16)
-
-        # Process each row after empty lines
-        for y in range(empty_lines, height):
-            row = pixel_data[y * width : (y + 1) * width]
-
-            # Find first non-transparent pixel
-            transparent_pixels = 0
-            while transparent_pixels < width and row[transparent_pixels] == 0:
-                transparent_pixels += 1
-
-            if transparent_pixels == width:
-                continue
-
-            # Find actual pixel data in this row
-            pixels_in_data = 0
-            row_data = bytearray()
-            for x in range(transparent_pixels, width):
-                if row[x] != 0:
-                    row_data.append(row[x])
-                    pixels_in_data += 1
-                else:
-                    break
-
-            # Write row data
-            image_data.append(transparent_pixels)  # transparent pixels count
-            # image_data.append(0xFF)
-
-            print(f"pixels_in_data: {pixels_in_data}")
-            if pixels_in_data > 0xFF:
-                image_data.append(0xFE)  # extended pixel count marker
-                image_data.append(pixels_in_data & 0xFF)
-            else:
-                image_data.append(pixels_in_data)  # pixel count
-
-            image_data.extend(row_data)
-
-        # Calculate total size and update header
-        total_size = len(image_data)
-        header = struct.pack(
-            "<IHHHHHH",
-            total_size,  # total size
-            width,  # width
-            height,  # height
-            0,  # unknown value 1
-            0,  # unknown 2
-            empty_lines,  # empty lines at top
-            cutoff_offset_y,  # cutoff offset
-        )
-
-        # Write header at start of image data
-        image_data[0:16] = header
-
-        # Write the image data
-        output_stream.write(image_data)
 
-    # Write end marker
-    output_stream.write(struct.pack("<I", 0xFFFFFFFF))
+    # each row's first opaque pixel and the first transparent one after it
+    starts = opaque.argmax(axis=1)
+    after = ~opaque & (np.arange(width) >= starts[:, np.newaxis])
+    ends = np.where(after.any(axis=1), after.argmax(axis=1), width)
+
+    # header placeholder
+    image_data = bytearray(16)
+    data = memoryview(pixels.tobytes())
+    for y in np.flatnonzero(opaque_rows[empty_lines:]) + empty_lines:
+        start = int(starts[y])
+        pixels_in_data = int(ends[y]) - start
+
+        image_data.append(start)  # transparent pixels count
+        if pixels_in_data > 0xFF:
+            image_data.append(0xFE)  # extended pixel count marker
+            image_data.append(pixels_in_data & 0xFF)
+        else:
+            image_data.append(pixels_in_data)  # pixel count
+
+        row = y * width + start
+        image_data += data[row : row + pixels_in_data]
+
+    image_data[0:16] = struct.pack(
+        "<IHHHHHH",
+        len(image_data),  # total size
+        width,  # width
+        height,  # height
+        0,  # unknown value 1
+        0,  # unknown 2
+        empty_lines,  # empty lines at top
+        cutoff_offset_y,  # cutoff offset
+    )
+    return image_data
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+"""
+Map RGB images onto a fixed palette through a nearest-colour lookup table.
+
+The table has one palette index for every colour in a reduced RGB cube
+(5 bits per channel by default, 32K entries). Once it's built, mapping an
+image is a single NumPy fancy-index. Tables are cached in memory and,
+optionally, on disk, keyed by a hash of the palette contents.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import hashlib
+import logging
+import os
+
+from shared import palette_array
+
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL.Image import Image as PILImage
+
+DITHER_MODES = ("floyd-steinberg", "ordered", "none")
+
+# 4x4 Bayer matrix
+_BAYER4 = ((0, 8, 2, 10), (12, 4, 14, 6), (3, 11, 1, 9), (15, 7, 13, 5))
+
+# (palette hash, bits) -> lookup table
+_luts: dict[tuple[str, int], np.ndarray] = {}
+
+
+def palette_colors(palette: bytes) -> np.ndarray:
+    """The palette as an (n, 3) array of RGB colours"""
+    return palette_array(bytes(palette))
+
+
+def build_lut(palette: bytes, bits: int = 5) -> np.ndarray:
+    """Nearest palette index for the centre of every cell of the RGB cube"""
+    import numpy as np
+
+    colors = palette_colors(palette).astype(np.int32)
+    levels = (np.arange(1 << bits, dtype=np.int32) << (8 - bits)) + (
+        (1 << (8 - bits)) >> 1
+    )
+    r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+    cube = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+
+    lut = np.empty(len(cube), dtype=np.uint8)
+    norms = (colors * colors).sum(axis=1)
+    for start in range(0, len(cube), 0x1000):
+        chunk = cube[start : start + 0x1000]
+        # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, |c|^2 is the same for every p
+        cost = norms - 2 * chunk @ colors.T
+        # the first of equally close palette entries wins
+        lut[start : start + 0x1000] = cost.argmin(axis=1)
+    return lut
+
+
+def palette_lut(palette: bytes, bits: int = 5, cache_dir=None) -> np.ndarray:
+    """Get the lookup table for a palette, building it at most once.
+
+    With a cache_dir, tables are also stored there as <hash>-<bits>.npy and
+    shared between runs.
+    """
+    import numpy as np
+
+    digest = hashlib.sha256(palette).hexdigest()
+    lut = _luts.get((digest, bits))
+    if lut is not None:
+        return lut
+
+    path = os.path.join(cache_dir, f"{digest}-{bits}.npy") if cache_dir else None
+    if path and os.path.exists(path):
+        lut = np.load(path)
+        logging.info(f"loaded palette lookup table {path}")
+    else:
+        lut = build_lut(palette, bits)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write then rename so concurrent workers never read a partial file
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, lut)
+            os.replace(tmp, path)
+            logging.info(f"saved palette lookup table {path}")
+
+    _luts[(digest, bits)] = lut
+    return lut
+
+
+def quantize(
+    image: PILImage,
+    palette: bytes,
+    dither: str = "floyd-steinberg",
+    bits: int = 5,
+    cache_dir=None,
+) -> PILImage:
+    """Convert an image to a "P" image using the given palette.
+
+    floyd-steinberg is PIL's error diffusion, ordered applies a 4x4 Bayer
+    matrix before the table lookup and none maps every pixel to its nearest
+    colour.
+    """
+    import numpy as np
+    from PIL import Image
+
+    if dither not in DITHER_MODES:
+        raise ValueError(f"Unknown dither mode: {dither}")
+
+    rgb_image = image.convert("RGB")
+
+    if dither == "floyd-steinberg":
+        palette_image = Image.new("P", (16, 16))
+        palette_image.putpalette(palette)
+        return rgb_image.quantize(palette=palette_image, dither=Image.FLOYDSTEINBERG)
+
+    rgb = np.asarray(rgb_image)
+    if dither == "ordered":
+        # spread the thresholds over roughly the distance between palette colours
+        spread = 256 / len(palette_colors(palette)) ** (1 / 3)
+        height, width = rgb.shape[:2]
+        # thresholds in [-0.5, 0.5)
+        bayer = (np.array(_BAYER4) + 0.5) / 16 - 0.5
+        threshold = np.tile(bayer, (height // 4 + 1, width // 4 + 1))
+        offset = threshold[:height, :width, np.newaxis] * spread
+        rgb = np.clip(rgb + offset, 0, 255).astype(np.uint8)
+
+    shift = 8 - bits
+    index = (
+        (rgb[..., 0].astype(np.intp) >> shift) << (2 * bits)
+        | (rgb[..., 1].astype(np.intp) >> shift) << bits
+        | rgb[..., 2] >> shift
+    )
+    pixels = palette_lut(palette, bits, cache_dir)[index]
+    quantized = Image.frombytes("P", rgb_image.size, pixels.tobytes())
+    quantized.putpalette(palette)
+    return quantized
@@ -1,65 +1,61 @@
 # based on JCivED PIC handling code
+import re
 
+# 4 or more equal bytes, shorter runs are cheaper as literals
+_RUN = re.compile(rb"(.)\1{3,}", re.DOTALL)
 
-def decode(codedData: bytes) -> list:
-    plainData = [codedData[0]]
+
+def decode(codedData: bytes) -> bytearray:
+    if not isinstance(codedData, (bytes, bytearray)):
+        codedData = bytes(codedData)
+    codedDataLen = len(codedData)
+    plainData = bytearray(codedData[:1])
     i = 1
-    while i < len(codedData):
-        if codedData[i] != 0x90:  # 0x90 is RLE control code for repetition
-            plainData.append(codedData[i])
-        else:  # 0x90 encountered
-            # If next byte is 0 then 0x90 is an actual byte
-            if codedData[i + 1] == 0x0:
-                plainData.append(codedData[i])
-                i += 1
-            else:  # Ok, we have a RLE code, let's manage it
-                repeatCount = codedData[i + 1]
-                i += 1
-                val = plainData[-1]
-                plainData += [val] * (repeatCount - 1)
-        i += 1
+    while i < codedDataLen:
+        # 0x90 is RLE control code for repetition, copy everything up to it.
+        # A 0x90 in the last byte has no count and is kept as is.
+        j = codedData.find(0x90, i, codedDataLen - 1)
+        if j == -1:
+            plainData += codedData[i:]
+            break
+        plainData += codedData[i:j]
+
+        repeatCount = codedData[j + 1]
+        # If next byte is 0 then 0x90 is an actual byte
+        if repeatCount == 0x0:
+            plainData.append(0x90)
+        else:  # Ok, we have a RLE code, let's manage it
+            plainData += plainData[-1:] * (repeatCount - 1)
+        i = j + 2
     return plainData
 
 
-def encode(plainData: bytes) -> list:
-    plainDataLen = len(plainData)
-    codedData = [0] * (2 * plainDataLen)
-    codedData[0] = plainData[0]
-    cnt = 1
-    repeating = False
-    repeatCount = 0
+def encode(plainData: bytes) -> bytearray:
+    plainData = bytes(plainData)
+    codedData = bytearray()
+    pos = 0
+
+    for run in _RUN.finditer(plainData):
+        start, end = run.span()
+        # Escape fake control codes in the literals before the run
+        codedData += plainData[pos:start].replace(b"\x90", b"\x90\x00")
+
+        # A run is written as its first byte followed by a repeat count, at
+        # most 255 bytes at a time. A tail of 3 bytes or less stays literal.
+        literal = plainData[start : start + 1].replace(b"\x90", b"\x90\x00")
+        repeatCount = end - start
+        while repeatCount > 3:
+            chunk = min(repeatCount, 255)
+            codedData += literal
+            codedData.append(0x90)
+            codedData.append(chunk)
+            repeatCount -= chunk
+        codedData += literal * repeatCount
+        pos = end
+
+    codedData += plainData[pos:].replace(b"\x90", b"\x90\x00")
 
-    for i in range(1, plainDataLen):
-        if plainData[i] != plainData[i - 1] or repeatCount == 254:
-            if repeating:
-                codedData[cnt] = 0x90
-                codedData[cnt + 1] = repeatCount + 1
-                cnt += 2
-            repeating = False
-            repeatCount = 0
-            codedData[cnt] = plainData[i]
-            if codedData[cnt] == 0x90:  # Escape fake control code
-                codedData[cnt + 1] = 0x0
-                cnt += 1
-            cnt += 1
-        else:
-            if repeating or (
-                i < plainDataLen - 2
-                and plainData[i + 1] == plainData[i]
-                and plainData[i + 2] == plainData[i]
-            ):
-                repeating = True
-                repeatCount += 1
-            else:
-                repeating = False
-                repeatCount = 0
-                codedData[cnt] = plainData[i]
-                if codedData[cnt] == 0x90:  # Escape fake control code
-                    codedData[cnt + 1] = 0x0
-                    cnt += 1
-                cnt += 1
-    if repeating:
-        codedData[cnt] = 0x90
-        codedData[cnt + 1] = repeatCount + 1
-        cnt += 2
-    return codedData[:cnt]
+    # The first byte is always written as is
+    if plainData[:1] == b"\x90":
+        del codedData[1]
+    return codedData
@@ -1,26 +1,73 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+import os
+import re
 import struct
 
+import timing
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# One "pal# - val1 val2 val3" entry per line, after dashes become spaces
+_TR_ENTRY = re.compile(rb"^[ \t]*(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\d+)", re.M)
+
+# (path, mtime, size) -> palette bytes, see load_palette
+_palettes: dict[tuple[str, int, int], bytes] = {}
+
 
 # Convert a .tr text palette to bytes
 def tr2pal(pal_file="TodPal.tr", default_color=(0, 0, 0)) -> bytes:
     """Parse .tr palette files into bytes"""
-    pal = [default_color] * 256
+    with open(pal_file, "rb") as read_pal:
+        return parse_tr(read_pal.read(), default_color)
+
+
+def parse_tr(text: bytes, default_color=(0, 0, 0)) -> bytes:
+    """Parse the contents of a .tr palette file, colours not in it are
+    default_color"""
+    pal = bytearray(bytes(default_color) * 256)
+    for pal_num, r, g, b in _TR_ENTRY.findall(text.replace(b"-", b" ")):
+        i = int(pal_num) * 3
+        if i > 255 * 3:
+            raise ValueError(f"Invalid palette index: {int(pal_num)}")
+        pal[i : i + 3] = bytes((int(r), int(g), int(b)))
+
+    pal[254 * 3 : 255 * 3] = b"\xff\xff\xff"  # Set the last color to black
+    return bytes(pal)
+
+
+def load_palette(pal_file: str) -> bytes:
+    """Load a binary .pal palette or a text .tr palette.
+
+    Palettes are only read again when the file changes (same path, mtime and
+    size), so batches and servers can call this for every file.
+    """
+    st = os.stat(pal_file)
+    key = (os.path.abspath(pal_file), st.st_mtime_ns, st.st_size)
+    palette = _palettes.get(key)
+    if palette is not None:
+        return palette
+
+    with timing.stage("palette.load", st.st_size) as s:
+        with open(pal_file, "rb") as f:
+            data = f.read()
+        palette = data if pal_file.endswith(".pal") else parse_tr(data)
+        s.bytes_out = len(palette)
+    _palettes[key] = palette
+    return palette
 
-    # Open text Palette and fill array
-    # format "pal# - val1 val2 val3"
-    with open(pal_file, "r") as read_pal:
-        for line in read_pal:
-            line = line.replace("-", " ")
-            temp = line.strip().split()
-            pal_num = int(temp[0])
-            rgb = temp[1:4]
-            pal[pal_num] = [int(x) for x in rgb]
 
-    pal[254] = (255, 255, 255)  # Set the last color to black
+@lru_cache(maxsize=64)
+def palette_array(palette: bytes) -> np.ndarray:
+    """The palette as a read-only (n, 3) array of RGB colours, shared by
+    every caller with the same palette"""
+    import numpy as np
 
-    # Convert the list of lists to a bytes object
-    byte_data = b"".join(struct.pack("<BBB", *pal[i]) for i in range(256))
-    return byte_data
+    colors = np.frombuffer(palette, dtype=np.uint8)
+    return colors[: len(colors) // 3 * 3].reshape(-1, 3)
 
 
 def pal2tpal(pal: bytes) -> list[tuple[int, int, int]]:
@@ -34,7 +81,8 @@ def pal_to_bytes(pal: list[tuple[int, int, int]]) -> bytes:
 
 def pic_version_help_message():
     return """
-    The version of the PIC file (3 or 98). Defaults to 3.
+    The version of the PIC file (3 or 98). Defaults to auto, which tells
+    them apart from the file header.
 
     ### Version 3 -
     Darklands,
@@ -0,0 +1,181 @@
+"""
+Tell Pic98, PICv3 and SPR files apart from their first bytes.
+
+Nothing is decompressed, only the fixed headers are checked:
+
+- Pic98 starts with the 00 "H8" 00 signature
+- PICv3 is a chain of PicV3BlockHeaders (X0, X1, M0, M1, C0, E0)
+- SPR is a chain of frame headers, each with a sane size, width and height,
+  ending in FFFFFFFF
+
+A PICv3 file that starts with an X0 or X1 block also reads as the size of a
+first SPR frame, too big to see its end in the sniffed bytes. sniff_stream
+follows such a chain through the file and only takes it for SPR if it ends
+in FFFFFFFF.
+"""
+
+from collections import namedtuple
+from typing import BinaryIO, Callable, Optional
+import os
+import struct
+
+from pic_headers import (
+    SPR_HEADER_SIZE,
+    SPR_MAX_FRAME_SIZE,
+    PicV3BlockHeader,
+    PicV3Image,
+    PicV3Palette,
+    SprFormat,
+    SprHeader,
+)
+
+PIC98 = "98"
+PICV3 = "3"
+SPR = "spr"
+
+# How much of a file sniff_stream reads. Enough for a full 256 colour palette
+# block ahead of the image block.
+SNIFF_SIZE = 1024
+
+PICV3_BLOCK_IDS = (b"X0", b"X1", b"M0", b"M1", b"C0", b"E0")
+
+# format is PIC98, PICV3 or SPR. layout is the PICv3 block ids in file order,
+# as far as the sniffed bytes reach, and None for the other formats.
+Sniffed = namedtuple("Sniffed", ["format", "layout"])
+
+
+def sniff(head: bytes, file_size: Optional[int] = None) -> Optional[Sniffed]:
+    """Identify a file from its first bytes, None if it's none of ours.
+
+    file_size, if known, lets SPR frames that run past the end of the file
+    be rejected. A file that is both a PICv3 and the start of an SPR, as far
+    as head reaches, is taken for PICv3, sniff_stream looks further.
+    """
+    if _is_pic98(head):
+        return Sniffed(PIC98, None)
+    layout = _picv3_layout(head)
+    spr = _follow_spr(_head_reader(head), len(head) if file_size is None else file_size)
+    if spr or (spr is None and not layout):
+        return Sniffed(SPR, None)
+    if layout:
+        return Sniffed(PICV3, layout)
+    return None
+
+
+def sniff_file(filename: str) -> Optional[Sniffed]:
+    """sniff() the start of a file"""
+    with open(filename, "rb") as f:
+        return sniff_stream(f)
+
+
+def sniff_stream(f: BinaryIO) -> Optional[Sniffed]:
+    """sniff() the next SNIFF_SIZE bytes of an open file, then seek back"""
+    start = f.tell()
+    head = f.read(SNIFF_SIZE)
+    file_size = f.seek(0, os.SEEK_END) - start
+    sniffed = sniff(head, file_size)
+    if (
+        sniffed is not None
+        and sniffed.format == PICV3
+        and _follow_spr(_head_reader(head), file_size) is None
+        and _follow_spr(_file_reader(f, start), file_size)
+    ):
+        sniffed = Sniffed(SPR, None)
+    f.seek(start)
+    return sniffed
+
+
+def detect_pic_version(f: BinaryIO) -> str:
+    """The PIC version of an open file, "3" or "98".
+
+    Raises ValueError if it isn't a PIC file.
+    """
+    sniffed = sniff_stream(f)
+    if sniffed is None:
+        raise ValueError("Not a PIC file")
+    if sniffed.format == SPR:
+        raise ValueError("This is an SPR file, not a PIC file")
+    return sniffed.format
+
+
+def _is_pic98(head: bytes) -> bool:
+    if len(head) < 8 or head[:4] != b"\x00H8\x00":
+        return False
+    width, height = struct.unpack_from("<HH", head, 4)
+    return width > 0 and height > 0
+
+
+def _picv3_layout(head: bytes) -> tuple:
+    """The block ids at the start of a PICv3 file, empty if it isn't one"""
+    layout = []
+    pos = 0
+    while pos + 4 <= len(head):
+        block = PicV3BlockHeader._make(struct.unpack_from("<2sH", head, pos))
+        if block.block_id not in PICV3_BLOCK_IDS:
+            return ()
+        pos += 4
+
+        if block.block_id in (b"X0", b"X1"):
+            if pos + 5 <= len(head):
+                image = PicV3Image._make(struct.unpack_from("<HHB", head, pos))
+                if image.width == 0 or image.height == 0:
+                    return ()
+            # the image data runs to the end of the file
+            layout.append(block.block_id.decode("ascii"))
+            break
+        elif block.block_id in (b"M0", b"M1"):
+            if pos + 2 <= len(head):
+                palette = PicV3Palette._make(struct.unpack_from("<BB", head, pos))
+                if palette.first > palette.last:
+                    return ()
+                # parse_palette reads by first and last, not by the length
+                pos += 2 + 3 * (palette.last + 1 - palette.first)
+            else:
+                pos += 2
+        else:
+            pos += block.length
+        layout.append(block.block_id.decode("ascii"))
+    return tuple(layout)
+
+
+def _follow_spr(read: Callable[[int, int], bytes], end: int) -> Optional[bool]:
+    """Follow a chain of SPR frame headers.
+
+    read(pos, n) returns up to n bytes at pos, end is the size of the file.
+    True if the chain ends in the end marker, False if it isn't an SPR, and
+    None if read ran out after at least one good frame.
+    """
+    pos = 0
+    frames = 0
+    while True:
+        data = read(pos, SPR_HEADER_SIZE)
+        if len(data) < 4:
+            return None if frames else False
+        (size,) = struct.unpack_from("<I", data)
+        if size == 0xFFFFFFFF:
+            # an empty SPR is only the end marker
+            return frames > 0 or pos + 4 == end
+        if size < SPR_HEADER_SIZE or size > SPR_MAX_FRAME_SIZE or pos + size > end:
+            return False
+        if len(data) == SPR_HEADER_SIZE:
+            header = SprHeader._make(struct.unpack(SprFormat, data))
+            if (
+                header.width == 0
+                or header.height == 0
+                or header.num_empty_lines_above > header.height
+            ):
+                return False
+        frames += 1
+        pos += size
+
+
+def _head_reader(head: bytes) -> Callable[[int, int], bytes]:
+    return lambda pos, n: head[pos : pos + n]
+
+
+def _file_reader(f: BinaryIO, start: int) -> Callable[[int, int], bytes]:
+    def read(pos, n):
+        f.seek(start + pos)
+        return f.read(n)
+
+    return read
@@ -1,19 +1,58 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from typing import TYPE_CHECKING, Optional
 import argparse
 import logging
+import mmap
 import os
 import struct
-
-from PIL import Image
-from PIL.Image import Image as PILImage
-
-from shared import tr2pal
+import sys
+
+from batch import add_batch_arguments, expand_inputs, output_path, run_batch
+from pic_headers import SPR_HEADER_SIZE, SPR_MAX_FRAME_SIZE, SprFormat, SprHeader
+from shared import load_palette
+import timing
+
+if TYPE_CHECKING:
+    from PIL.Image import Image as PILImage
+
+# A frame's header and where it starts in the file
+SprFrame = namedtuple("SprFrame", ["offset", "header"])
+
+# Sheet columns by file name, the first entry whose name is in the path (and
+# whose exclude isn't) wins. Other files get as many columns as fit in
+# SHEET_MAX_WIDTH pixels.
+SHEET_LAYOUTS = (
+    # (name, exclude, columns)
+    ("Dome", None, 4),
+    ("Cstline", None, 4),
+    ("Castle", None, 2),
+    ("Sland", None, 5),
+    ("Land", "tile", 5),
+    ("Moon", None, 8),
+    ("Dungeon", None, 12),
+    ("Worlds", None, 12),
+)
+SHEET_MAX_WIDTH = 1240
+# Narrower frames are left out of sheets
+SHEET_MIN_FRAME_WIDTH = 10
+
+# Fewer frames than this are split in this process
+PARALLEL_SPLIT_MIN = 64
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert SPR files to PNG")
-    parser.add_argument("file", help="The SPR file to convert.")
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="The SPR files, directories or glob patterns to convert.",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -24,6 +63,38 @@ def main():
     parser.add_argument(
         "-p", "--palette", help="The palette file to use.", default=None
     )
+    parser.add_argument(
+        "-f",
+        "--frame",
+        type=int,
+        action="append",
+        help="Only convert this frame, to <file>.<frame>.png, instead of the "
+        "whole sheet. Can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--split",
+        action="store_true",
+        help="Write every frame to <file>.<frame>.png instead of a sheet.",
+    )
+    parser.add_argument(
+        "--columns",
+        type=int,
+        default=None,
+        help="Number of frames per sheet row, instead of picking it from the "
+        "file name.",
+    )
+    parser.add_argument(
+        "--layout",
+        action="append",
+        default=[],
+        metavar="NAME=COLUMNS",
+        type=parse_layout,
+        help="Use COLUMNS frames per sheet row for files with NAME in their "
+        "path. Checked before the built in layouts, can be specified "
+        "multiple times.",
+    )
+    add_batch_arguments(parser)
+    timing.add_profile_argument(parser)
     args = parser.parse_args()
 
     if args.verbose >= 2:
@@ -33,162 +104,411 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    filename = args.file
     if not args.palette:
         args.palette = "TodPal.tr"
 
+    files = expand_inputs(args.files, (".spr",))
+    if not files:
+        parser.error(f"no input files in {' '.join(args.files)}")
+    timing.enable_from_args(args)
+
+    convert = partial(
+        convert_file,
+        frames=args.frame,
+        split=args.split,
+        layouts=tuple(args.layout) + SHEET_LAYOUTS,
+        columns=args.columns,
+    )
+    if len(files) == 1:
+        # a batch already runs a process per file, a single file gets the
+        # workers for its frames
+        convert(files[0], args.output_dir, load_palette(args.palette), jobs=args.jobs)
+        failures = 0
+    else:
+        failures = run_batch(
+            convert, files, args.output_dir, args.jobs, load_palette, (args.palette,)
+        )
+
+    timing.report_from_args(args)
+    if failures:
+        sys.exit(1)
+
+
+def parse_layout(value: str) -> tuple:
+    """Parse a NAME=COLUMNS --layout option into a SHEET_LAYOUTS entry"""
+    name, sep, columns = value.rpartition("=")
+    if not sep or not name or not columns.isdigit() or int(columns) < 1:
+        raise argparse.ArgumentTypeError(f"expected NAME=COLUMNS, got {value!r}")
+    return (name, None, int(columns))
+
+
+def convert_file(
+    filename: str,
+    out_dir: str,
+    palette: bytes,
+    frames: Optional[list[int]] = None,
+    split: bool = False,
+    layouts: tuple = SHEET_LAYOUTS,
+    columns: Optional[int] = None,
+    jobs: Optional[int] = 1,
+) -> str:
+    """Convert one SPR file to <out_dir>/<basename>.png
+
+    With frames, or split for all of them, each frame is written to
+    <basename>.<frame>.png instead. Split frames are written by up to `jobs`
+    processes.
+    """
+    if split:
+        return split_file(filename, out_dir, palette, jobs)
+    if frames:
+        return save_frames(filename, out_dir, palette, frames)
+
     # open file as binary
     with open(filename, "rb") as f:
-        # parse pic format
-        # images = parse_spr(f, os.path.basename(filename), pal)
-        image = parse_spr(f, filename, tr2pal(args.palette))
-        out = f"{os.path.basename(filename)}.png"
-        logging.debug(f"saving to {out}")
+        image = parse_spr(f, filename, palette, layouts, columns)
+    out = output_path(filename, out_dir, ".png")
+    logging.debug(f"saving to {out}")
+    save_png(image, out)
+    return out
+
+
+def save_frames(filename: str, out_dir: str, palette: bytes, frames) -> str:
+    """Write the given frames to <out_dir>/<basename>.<frame>.png"""
+    with SprFile(filename, palette) as spr:
+        for i in frames:
+            out = output_path(filename, out_dir, f".{i}.png")
+            logging.debug(f"saving frame {i} to {out}")
+            save_png(spr.frame(i), out)
+    return out
+
+
+def split_file(
+    filename: str, out_dir: str, palette: bytes, jobs: Optional[int] = None
+) -> str:
+    """Write every frame to its own file, in up to `jobs` processes.
+
+    Each process maps the file and decodes its own share of the frames.
+    """
+    with open(filename, "rb") as f, map_stream(f) as buf:
+        count = len(index_spr(buf)[0])
+    if count == 0:
+        raise ValueError(f"No frames in {filename}")
+
+    workers = min(jobs or os.cpu_count() or 1, count)
+    if workers < 2 or count < PARALLEL_SPLIT_MIN:
+        return save_frames(filename, out_dir, palette, range(count))
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # contiguous runs of frames, so each process reads one part of the file
+    step = -(-count // workers)
+    chunks = [range(i, min(i + step, count)) for i in range(0, count, step)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        outs = list(pool.map(partial(save_frames, filename, out_dir, palette), chunks))
+    return outs[-1]
+
+
+def save_png(image: PILImage, out: str):
+    with timing.stage("png.save", image.width * image.height) as s:
         image.save(out)
+        s.bytes_out = os.path.getsize(out)
+
+
+@contextmanager
+def map_stream(data_stream):
+    """Memory-map an open file as a read-only memoryview.
+
+    Streams that can't be mapped (BytesIO, pipes, empty files) are read into
+    memory instead.
+    """
+    try:
+        mm = mmap.mmap(data_stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        mm = None
+
+    if mm is None:
+        pos = data_stream.tell()
+        data_stream.seek(0)
+        data = data_stream.read()
+        data_stream.seek(pos)
+        yield memoryview(data)
+        return
+
+    with mm, memoryview(mm) as buf:
+        yield buf
+
+
+def read_spr_header(buf, pos: int) -> Optional[SprHeader]:
+    """Read the frame header at pos, None at the end of image data marker"""
+    # Read the image data size (4 bytes, unsigned int)
+    (image_data_size,) = struct.unpack_from("<I", buf, pos)
+    if image_data_size == 0xFFFFFFFF:
+        return None
+
+    if image_data_size > SPR_MAX_FRAME_SIZE:
+        logging.error(f"invalid image data size: {image_data_size} {pos}")
+        logging.error(bytes(buf[pos : pos + 4]))
+        raise ValueError(f"Invalid image data size: {image_data_size}")
+
+    return SprHeader._make(struct.unpack_from(SprFormat, buf, pos))
+
+
+def decode_spr_rows(buf, pos: int, header: SprHeader, out, offset=0, stride=None):
+    """
+    Decode the rows of the frame at buf[pos:] into out.
+
+    Row y lands at out[offset + y * stride], so frames can be decoded straight
+    into a bigger sheet. Transparent pixels are not written, out is expected
+    to be zero filled.
+    """
+    width = header.width
+    stride = stride or width
+    end = pos + header.length
+    buf_len = len(buf)
+    i = pos + SPR_HEADER_SIZE
+
+    for y in range(header.num_empty_lines_above, header.height):
+        # Skip transparent pixel markers (0xFF) until we encounter valid data
+        while i < end and buf[i] == 0xFF:
+            i += 1
+
+        # Read transparent pixel amount and unknown data, the row needs at
+        # least one more byte after them
+        if i + 2 >= end:
+            break
+        transparent_pixels = buf[i]
+        unknown3 = buf[i + 1]
+        i += 2
+
+        # Determine number of pixels to process in this row
+        if unknown3 not in (0xFE, 0xFF):
+            pixels_in_data = unknown3
+        else:
+            pixels_in_data = buf[i]
+            i += 1
+            if i >= end:
+                break
 
+        if transparent_pixels > width or pixels_in_data > width:
+            logging.error(bytes(buf[i - 10 : i]))
+            raise ValueError(f"Invalid pixels in data: {pixels_in_data}")
 
-# SPR files aren't compressed or encoded, they're raw images
-# A given SPR file can contain multiple images,
-def parse_spr(data_stream, filename: str, palette: bytes) -> PILImage:
-    bitmaps: list[PILImage] = []
-
-    while True:
-        start = data_stream.tell()
-        logging.info(f"tell: {data_stream.tell()} img: {len(bitmaps)}")
-        # Read the image data size (4 bytes, unsigned int)
-        image_data_size = struct.unpack("<I", data_stream.read(4))[0]
-        end = start + image_data_size
-        if image_data_size == 0xFFFFFFFF:
-            logging.info("end of image data")
-            break  # End of image data
-
-        if image_data_size > 100_000:
-            logging.error(
-                f"invalid image data size: {image_data_size} {data_stream.tell()}"
-            )
-            data_stream.seek(-4, 1)
-            logging.error(data_stream.read(4))
-            raise ValueError(f"Invalid image data size: {image_data_size}")
+        # Copy the row data in bulk (pixels_in_data is the number of
+        # non-transparent pixels in this row), clipped to the frame width
+        n = min(pixels_in_data, width - transparent_pixels, buf_len - i)
+        row = offset + y * stride + transparent_pixels
+        out[row : row + n] = buf[i : i + n]
+        i += pixels_in_data
 
-        # Read width and height (2 bytes each)
-        width, height = struct.unpack("<HH", data_stream.read(4))
+    if i < end:
+        logging.info(f"curr: {i} end: {end} {bytes(buf[i:end])}")
 
-        # Skip the unknown 2-byte values
-        u1, u2 = struct.unpack("<HH", data_stream.read(4))
-        # logging.info(f"unknown1/2: {data_stream.read(4)}")
 
-        # Read number of empty lines and cutoff offset (2 bytes each)
-        empty_lines, _cutoff_offset_y = struct.unpack("<HH", data_stream.read(4))
+def index_spr(buf, pos: int = 0) -> tuple[list[SprFrame], int]:
+    """
+    Find every frame of an SPR file without decoding any pixels.
 
-        logging.info(
-            f"hdr - w:{width} h:{height} size:{image_data_size} empty_lines:{empty_lines} u1:{u1} u2:{u2}"
-        )
+    Only the size prefixes and frame headers are read. Returns the frames and
+    the position just past the end of image data marker.
+    """
+    frames = []
+    while True:
+        header = read_spr_header(buf, pos)
+        if header is None:
+            return frames, pos + 4  # End of image data
+        frames.append(SprFrame(pos, header))
+        pos += header.length
+
+
+def make_frame_image(frame: SprFrame, pixel_data, palette: bytes) -> PILImage:
+    """Wrap decoded frame pixels in a 'P' image (indexed by the palette)"""
+    from PIL import Image
+
+    width, height = frame.header.width, frame.header.height
+    bitmap = Image.frombuffer("P", (width, height), pixel_data, "raw", "P", 0, 1)
+    bitmap.putpalette(palette)
+    bitmap.info["transparency"] = 0
+    return bitmap
+
+
+class SprFile:
+    """
+    Random access to the frames of an SPR file.
+
+    Opening the file only builds the frame offset table (see index_spr).
+    Frames are decoded when they are asked for, and the most recently used
+    ones are kept decoded. `source` is a path, which is memory-mapped, or a
+    bytes-like object.
+    """
+
+    def __init__(self, source, palette: bytes, cache_size: int = 16):
+        self._file = None
+        self._mmap = None
+        if isinstance(source, (str, os.PathLike)):
+            self._file = open(source, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            source = self._mmap
+        self._buf = memoryview(source).cast("B")
+        self.palette = palette
+        with timing.stage("spr.index", len(self._buf)):
+            self.frames, _ = index_spr(self._buf)
+        self.cache_size = cache_size
+        self._cache: OrderedDict[int, PILImage] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __getitem__(self, i: int) -> PILImage:
+        return self.frame(i)
+
+    def frame(self, i: int) -> PILImage:
+        """Decoded frame i, negative indexes count from the end"""
+        i = range(len(self.frames))[i]
+        bitmap = self._cache.get(i)
+        if bitmap is not None:
+            self._cache.move_to_end(i)
+            return bitmap
+
+        frame = self.frames[i]
+        logging.info(f"decoding frame {i} at {frame.offset}")
+        pixel_data = bytearray(frame.header.width * frame.header.height)
+        with timing.stage("spr.decode", frame.header.length) as s:
+            decode_spr_rows(self._buf, frame.offset, frame.header, pixel_data)
+            s.bytes_out = len(pixel_data)
+        bitmap = make_frame_image(frame, pixel_data, self.palette)
+
+        self._cache[i] = bitmap
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return bitmap
+
+    def close(self):
+        self._cache.clear()
+        self._buf.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-        # Fill with "blank lines above"
-        pixel_data = b"\x00" * width * empty_lines
 
-        # Process each row
-        for y in range(empty_lines, height):
-            # logging.info(f"y: {y} {data_stream.tell()} end: {end}")
-            if data_stream.tell() >= end:
-                break
-            # Skip transparent pixel markers (0xFF) until we encounter valid data
-            while True:
-                if data_stream.tell() >= end:
-                    break
-
-                marker = data_stream.read(1)
-                if not marker or marker != b"\xFF":
-                    break
-            # logging.info(f" post_marker y: {y} {data_stream.tell()} end: {end}")
-
-            # Read transparent pixel amount and unknown data
-            transparent_pixels = struct.unpack("<B", marker)[0]
-            unknown3 = struct.unpack("<B", data_stream.read(1))[0]
-            if unknown3 not in (0xFE, 0xFF):
-                logging.debug(f"tp: {transparent_pixels} u3: {unknown3}")
-
-            # Determine number of pixels to process in this row
-            if unknown3 not in (0xFE, 0xFF):
-                pixels_in_data = unknown3
-            else:
-                pixels_in_data = struct.unpack("<B", data_stream.read(1))[0]
+# SPR files aren't compressed or encoded, they're raw images
+# A given SPR file can contain multiple images,
+def parse_spr(
+    data_stream,
+    filename: str,
+    palette: bytes,
+    layouts: tuple = SHEET_LAYOUTS,
+    columns: Optional[int] = None,
+) -> PILImage:
+    """Decode every frame of an SPR file into one sheet"""
+    with map_stream(data_stream) as buf:
+        with timing.stage("spr.index", len(buf)):
+            frames, end = index_spr(buf, data_stream.tell())
+        for i, frame in enumerate(frames):
+            header = frame.header
+            logging.info(
+                f"tell: {frame.offset} img: {i} - "
+                f"w:{header.width} h:{header.height} size:{header.length} "
+                f"empty_lines:{header.num_empty_lines_above} "
+                f"u1:{header.unknown} u2:{header.unknown2}"
+            )
+        sheet = compose_sheet(buf, frames, filename, palette, layouts, columns)
 
-            if data_stream.tell() - start >= image_data_size:
-                break
+    data_stream.seek(end)
+    return sheet
 
-            if transparent_pixels > width or pixels_in_data > width:
-                data_stream.seek(-10, 1)
-                logging.error(data_stream.read(10))
-                raise ValueError(f"Invalid pixels in data: {pixels_in_data}")
 
-            logging.debug(
-                f"t: {data_stream.tell()} tp: {transparent_pixels} pd: {pixels_in_data} sz: {len(pixel_data)} y: {y}"
-            )
-            # Read the raw pixel data in bulk (pixels_in_data is the number of
-            # non-transparent pixels in this row)
-            row_data = data_stream.read(pixels_in_data)
-
-            pixel_data += b"\x00" * transparent_pixels  # Add transparent pixels
-            pixel_data += row_data  # Add the row data
-            pixel_data += b"\x00" * (width - transparent_pixels - pixels_in_data)
-
-        # fill remaining image with transparent pixels
-        if len(pixel_data) < width * height:
-            pixel_data += b"\x00" * ((width * height) - len(pixel_data))
-
-        curr = data_stream.tell()
-        if curr < end:
-            logging.info(f"curr: {curr} end: {end} {data_stream.read(end - curr)}")
-
-        # move to next image
-        data_stream.seek(end)
-
-        # Now create the image using the 'P' mode and the palette
-        # Create a new Image with mode 'P' (paletted)
-        bitmap = Image.new("P", (width, height))
-
-        # Put the pixel data into the image (indexed by the palette)
-        logging.debug(f"image - actual: {len(pixel_data)} expected: {width * height}")
-        bitmap.putdata(pixel_data)
-        bitmap.putpalette(palette)
-        bitmap.info["transparency"] = 0
-
-        # Append the image to the result list
-        bitmaps.append(bitmap)
-
-    width, height = bitmaps[0].size
-
-    bitmaps = [b for b in bitmaps if b.width >= 10]
-
-    modulo = min(1240 // width, len(bitmaps))
-    if "Dome" in filename or "Cstline" in filename:
-        modulo = 4
-    elif "Castle" in filename:
-        modulo = 2
-    elif "Sland" in filename or ("Land" in filename and "tile" not in filename):
-        modulo = 5
-    elif "Moon" in filename:
-        modulo = 8
-    elif "Dungeon" in filename or "Worlds" in filename:
-        modulo = 12
-
-    if len(bitmaps) % modulo != 0:
-        logging.warning(f"modulo mismatch: {len(bitmaps)} % {modulo}")
-
-    logging.info(
-        f"bitmaps: {len(bitmaps)} modulo: {modulo} rem: {len(bitmaps) % modulo}"
-    )
-    sheet_width = width * modulo
-    sheet_height = height * (len(bitmaps) // modulo)
-
-    sheet = Image.new("P", (sheet_width, sheet_height))
-    sheet.putpalette(palette)
-    sheet.info["transparency"] = 0
-    for i, bitmap in enumerate(bitmaps):
-        x = (i % modulo) * width
-        y = (i // modulo) * height
-        sheet.paste(bitmap, (x, y))
+def sheet_columns(
+    filename: str,
+    frame_width: int,
+    count: int,
+    layouts: tuple = SHEET_LAYOUTS,
+    columns: Optional[int] = None,
+) -> int:
+    """Number of frames per sheet row, see SHEET_LAYOUTS"""
+    if columns is None:
+        columns = min(SHEET_MAX_WIDTH // frame_width, count)
+        for name, exclude, layout_columns in layouts:
+            if name in filename and not (exclude and exclude in filename):
+                columns = layout_columns
+                break
+    if columns < 1:
+        raise ValueError(f"Can't lay out {count} frames of width {frame_width}")
+
+    if count % columns != 0:
+        logging.warning(f"modulo mismatch: {count} % {columns}")
+    logging.info(f"bitmaps: {count} modulo: {columns} rem: {count % columns}")
+    return columns
+
+
+def compose_sheet(
+    buf,
+    frames: list[SprFrame],
+    filename: str,
+    palette: bytes,
+    layouts: tuple = SHEET_LAYOUTS,
+    columns: Optional[int] = None,
+) -> PILImage:
+    """Decode frames straight into a grid of cells the size of the first frame.
+
+    Frames narrower than SHEET_MIN_FRAME_WIDTH are left out, and so is an
+    incomplete last row. A frame bigger than its cell covers the cells to its
+    right and below, until the frames there are drawn over it.
+    """
+    import numpy as np
+    from PIL import Image
+
+    if not frames:
+        raise ValueError(f"No frames in {filename}")
+    width, height = frames[0].header.width, frames[0].header.height
+    frames = [f for f in frames if f.header.width >= SHEET_MIN_FRAME_WIDTH]
+    columns = sheet_columns(filename, width, len(frames), layouts, columns)
+    rows = len(frames) // columns
+
+    sheet_width = width * columns
+    sheet_height = height * rows
+    with timing.stage("sheet.compose") as s:
+        data = bytearray(sheet_width * sheet_height)
+        cells = np.frombuffer(data, dtype=np.uint8).reshape(sheet_height, sheet_width)
+        overlapped = False
+        bytes_in = 0
+        for i, frame in enumerate(frames[: columns * rows]):
+            header = frame.header
+            x = (i % columns) * width
+            y = (i // columns) * height
+            if overlapped:
+                # transparent pixels aren't written, clear what a bigger
+                # frame left behind
+                cells[y : y + header.height, x : x + header.width] = 0
+            if x + header.width <= sheet_width and y + header.height <= sheet_height:
+                decode_spr_rows(
+                    buf, frame.offset, header, data, y * sheet_width + x, sheet_width
+                )
+            else:
+                # clip the frame at the edge of the sheet
+                pixel_data = bytearray(header.width * header.height)
+                decode_spr_rows(buf, frame.offset, header, pixel_data)
+                pixels = np.frombuffer(pixel_data, dtype=np.uint8).reshape(
+                    header.height, header.width
+                )
+                cells[y : y + header.height, x : x + header.width] = pixels[
+                    : sheet_height - y, : sheet_width - x
+                ]
+            overlapped |= header.width > width or header.height > height
+            bytes_in += header.length
+        s.bytes_in = bytes_in
+        s.bytes_out = len(data)
+
+        sheet = Image.frombuffer(
+            "P", (sheet_width, sheet_height), data, "raw", "P", 0, 1
+        )
+        sheet.putpalette(palette)
+        sheet.info["transparency"] = 0
     return sheet
 
 
@@ -0,0 +1,164 @@
+"""
+Per-stage timing for the command line tools (--profile).
+
+Codec stages are wrapped in a timer:
+
+    with timing.stage("lzss.decompress", len(data)) as s:
+        plane = lzss_decompress_bytes(data)
+        s.bytes_out = len(plane)
+
+Nothing is recorded until enable() is called. While disabled, stage()
+returns a shared do-nothing context manager, so the hooks can stay in the
+codecs for good.
+"""
+
+import json
+import sys
+import time
+
+_enabled = False
+
+# (name, seconds, bytes_in, bytes_out) for every stage run so far
+_records = []
+
+
+class _Stage:
+    __slots__ = ("name", "bytes_in", "bytes_out", "start")
+
+    def __init__(self, name, bytes_in):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        _records.append((self.name, elapsed, self.bytes_in, self.bytes_out))
+
+
+class _NullStage:
+    """Stands in for _Stage while timing is off. The byte counts read as 0
+    and writes to them are dropped, so the one instance can be shared."""
+
+    __slots__ = ()
+    bytes_in = 0
+    bytes_out = 0
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL = _NullStage()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def stage(name: str, bytes_in: int = 0):
+    """Time the body of a with block as `name`, set bytes_out on the result"""
+    if not _enabled:
+        return _NULL
+    return _Stage(name, bytes_in)
+
+
+def take() -> list:
+    """Return and clear the records, e.g. to send them from a worker process"""
+    records = _records[:]
+    _records.clear()
+    return records
+
+
+def merge(records: list):
+    """Add records taken in another process"""
+    _records.extend(records)
+
+
+def summary() -> list[dict]:
+    """Totals per stage name, in the order the stages first ran.
+
+    ratio is bytes_out / bytes_in, so it's above 1 for decoders.
+    """
+    totals = {}
+    for name, seconds, bytes_in, bytes_out in _records:
+        total = totals.setdefault(
+            name,
+            {"stage": name, "calls": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0},
+        )
+        total["calls"] += 1
+        total["seconds"] += seconds
+        total["bytes_in"] += bytes_in
+        total["bytes_out"] += bytes_out
+
+    for total in totals.values():
+        total["ratio"] = (
+            total["bytes_out"] / total["bytes_in"]
+            if total["bytes_in"] and total["bytes_out"]
+            else None
+        )
+    return list(totals.values())
+
+
+def report(destination: str):
+    """Print the summary as a table to stderr if destination is "-",
+    otherwise write it to that file as JSON"""
+    stages = summary()
+    if destination != "-":
+        with open(destination, "w") as f:
+            json.dump({"stages": stages}, f, indent=2)
+        return
+
+    print(
+        f"{'stage':<20} {'calls':>6} {'ms':>10} {'bytes in':>10} {'bytes out':>10} "
+        f"{'ratio':>7}",
+        file=sys.stderr,
+    )
+    for s in stages:
+        ratio = f"{s['ratio']:.3f}" if s["ratio"] is not None else "-"
+        print(
+            f"{s['stage']:<20} {s['calls']:>6} {s['seconds'] * 1000:>10.2f} "
+            f"{s['bytes_in']:>10} {s['bytes_out']:>10} {ratio:>7}",
+            file=sys.stderr,
+        )
+
+
+def add_profile_argument(parser):
+    """Add the --profile and --profile-json options to a command line parser"""
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time every conversion stage and print a summary to stderr.",
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="JSON_FILE",
+        help="Time every conversion stage and write the summary to JSON_FILE.",
+    )
+
+
+def enable_from_args(args):
+    """enable() if --profile or --profile-json was given"""
+    if args.profile or args.profile_json:
+        enable()
+
+
+def report_from_args(args):
+    """report() wherever --profile and --profile-json asked for"""
+    if args.profile:
+        report("-")
+    if args.profile_json:
+        report(args.profile_json)